@@ -0,0 +1,144 @@
+"""
+Benchmarks for the REST and websocket paths, run from the backend directory:
+
+    python -m benchmarks run [--scenarios login,listing,fetch,rooms] [--output results.json]
+    python -m benchmarks compare before.json after.json
+
+`run` starts the app in a subprocess against a temporary SQLite database,
+runs the scenarios one after another and writes a JSON report (to stdout
+unless --output is given) holding latency percentiles, throughput, and
+the server's commits per second and event loop lag under each load. The
+report records the commit it was made at; `compare` lines two of them up.
+Needs httpx besides the app's own requirements.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Dict, List
+
+from benchmarks.harness import BACKEND_DIR, Server
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="2note-bench-")
+    # The seeding in this process and the server must use the same database
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ["BROADCAST_SOCKET_PATH"] = os.path.join(workdir, "broadcast.sock")
+    # Imported only now: importing the models connects to DATABASE_URL
+    from benchmarks.scenarios import SCENARIOS
+
+    names = args.scenarios.split(",")
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+
+    report = {"meta": _meta(args), "scenarios": {}}
+    server = Server(workdir)
+    server.start()
+    try:
+        for name in names:
+            print(f"Running {name}…", file=sys.stderr)
+            report["scenarios"][name] = asyncio.run(SCENARIOS[name](server, args))
+    finally:
+        server.stop()
+        if args.keep:
+            print(f"Database and server log kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = _flatten(json.load(f)["scenarios"])
+    with open(args.after) as f:
+        after = _flatten(json.load(f)["scenarios"])
+    width = max((len(key) for key in before), default=0)
+    for key, old in before.items():
+        new = after.get(key)
+        if new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else ""
+        print(f"{key:<{width}}  {old:>12g}  {new:>12g}  {change:>8}")
+
+
+def _flatten(report: dict, prefix: str = "") -> Dict[str, float]:
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def _meta(args) -> dict:
+    def git(*command: str) -> str:
+        try:
+            return subprocess.run(
+                ["git", *command], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {key: value for key, value in vars(args).items() if key not in ("handler", "output", "keep")},
+    }
+
+
+def _ints(value: str) -> List[int]:
+    return [int(part) for part in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="2note benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runner = commands.add_parser("run", help="run the scenarios and write a JSON report")
+    runner.add_argument("--scenarios", default="login,listing,fetch,rooms", help="comma separated (default %(default)s)")
+    runner.add_argument("--output", help="write the report here instead of stdout")
+    runner.add_argument("--keep", action="store_true", help="keep the temporary database and server log")
+    runner.add_argument("--concurrency", type=int, default=20, help="requests in flight at once (default %(default)s)")
+    runner.add_argument("--requests", type=int, default=500, help="requests per listing and fetch measurement (default %(default)s)")
+    runner.add_argument("--users", type=int, default=50, help="distinct users in the login storm (default %(default)s)")
+    runner.add_argument("--logins", type=int, default=200, help="logins in the login storm (default %(default)s)")
+    runner.add_argument("--documents", type=_ints, default=[100, 1000, 10000], help="dashboard sizes to list (default 100,1000,10000)")
+    runner.add_argument("--sizes", type=_ints, default=[1024, 65536, 1048576], help="document sizes to fetch, in bytes (default 1024,65536,1048576)")
+    runner.add_argument("--rooms", type=int, default=5, help="websocket rooms (default %(default)s)")
+    runner.add_argument("--editors", type=int, default=5, help="editors per room (default %(default)s)")
+    runner.add_argument("--keystrokes-per-second", type=float, default=5, help="per editor (default %(default)s)")
+    runner.add_argument("--duration", type=float, default=10, help="seconds the editors type for (default %(default)s)")
+    runner.set_defaults(handler=run)
+
+    comparison = commands.add_parser("compare", help="line up two reports, e.g. from before and after a change")
+    comparison.add_argument("before")
+    comparison.add_argument("after")
+    comparison.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Running the server under test and loading it: the probed app in a uvicorn
+subprocess against a temporary database, and a driver that keeps a fixed
+number of requests in flight.
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from benchmarks.stats import summarize
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+# How long the server may take to start before the run is abandoned
+SERVER_START_TIMEOUT_SECONDS = 30
+
+
+class Server:
+    """
+    benchmarks.server:app in its own process, so that the client's work
+    doesn't show up as the server's event loop lag.
+    """
+
+    def __init__(self, workdir: str, env: Optional[Dict[str, str]] = None):
+        self.workdir = workdir
+        self.port = _free_port()
+        self.env = {**os.environ, **(env or {})}
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    def start(self):
+        log = open(os.path.join(self.workdir, "server.log"), "ab")
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "benchmarks.server:app",
+                "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning",
+            ],
+            cwd=BACKEND_DIR,
+            env=self.env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        log.close()
+        deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.process.returncode}, see {self.workdir}/server.log")
+            try:
+                httpx.get(self.url + "/__bench__/stats", timeout=1).raise_for_status()
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"Server did not start within {SERVER_START_TIMEOUT_SECONDS}s")
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    async def reset_probes(self, client: httpx.AsyncClient):
+        (await client.post(self.url + "/__bench__/reset")).raise_for_status()
+
+    async def read_probes(self, client: httpx.AsyncClient) -> dict:
+        response = await client.get(self.url + "/__bench__/stats")
+        response.raise_for_status()
+        return response.json()
+
+
+@dataclass
+class LoadResult:
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0.0
+    bytes_received: int = 0
+
+    def report(self) -> dict:
+        requests = len(self.latencies) + self.errors
+        return {
+            "requests": requests,
+            "errors": self.errors,
+            "throughput_rps": round(requests / self.elapsed, 2) if self.elapsed else 0.0,
+            "latency": summarize(self.latencies),
+            "bytes_per_response": round(self.bytes_received / requests) if requests else 0,
+        }
+
+
+async def run_load(
+    total: int,
+    concurrency: int,
+    request: Callable[[int], Awaitable[httpx.Response]],
+) -> LoadResult:
+    """
+    Make `total` requests, `concurrency` at a time; `request` is given the
+    number of the request to make. Anything but a 2xx or 304 is an error.
+    """
+    result = LoadResult()
+    counter = iter(range(total))
+
+    async def worker():
+        for number in counter:
+            started = time.perf_counter()
+            try:
+                response = await request(number)
+            except httpx.HTTPError:
+                result.errors += 1
+                continue
+            if response.is_success or response.status_code == 304:
+                result.latencies.append(time.perf_counter() - started)
+            else:
+                result.errors += 1
+            result.bytes_received += response.num_bytes_downloaded
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(total, concurrency))))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def client(concurrency: int) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(limits=limits, timeout=120)
+
+
+async def login(client: httpx.AsyncClient, server: Server, email: str, password: str) -> str:
+    response = await client.post(server.url + "/token", data={"username": email, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
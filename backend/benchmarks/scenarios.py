@@ -0,0 +1,220 @@
+"""
+The benchmark scenarios. Each seeds what it needs, resets the server's
+probes, puts its load on the server and returns a JSON-ready report that
+includes what the probes saw meanwhile.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+import websockets
+from benchmarks import seed
+from benchmarks.harness import Server, client, login, run_load
+from benchmarks.stats import summarize
+
+# Inserted by the editors so receivers can tell whose keystroke arrived when
+_MARKER = re.compile(r"<(k[\d.]+)>")
+
+
+async def login_storm(server: Server, options: argparse.Namespace) -> dict:
+    """
+    Many users logging in at once; password hashing is the bottleneck and
+    must not stall the event loop.
+    """
+    seed.create_users("login", options.users)
+    async with client(options.concurrency) as http:
+        await server.reset_probes(http)
+        result = await run_load(
+            options.logins,
+            options.concurrency,
+            lambda number: http.post(server.url + "/token", data={
+                "username": seed.email("login", number % options.users),
+                "password": seed.PASSWORD,
+            }),
+        )
+        return {**result.report(), "server": await server.read_probes(http)}
+
+
+async def listing(server: Server, options: argparse.Namespace) -> dict:
+    """
+    The dashboard for users with N documents: the first page, which is what
+    opening the dashboard costs, and a walk through every page.
+    """
+    report = {}
+    for count in options.documents:
+        owner, other = seed.create_users(f"list{count}", 2)
+        # A third of them shared, so both halves of the listing have rows
+        seed.create_documents(owner, count - count // 3, 200)
+        seed.create_documents(other, count // 3, 200, shared_with=[owner])
+        async with client(options.concurrency) as http:
+            token = await login(http, server, seed.email(f"list{count}", 0), seed.PASSWORD)
+            headers = {"Authorization": f"Bearer {token}"}
+            await server.reset_probes(http)
+            first_page = await run_load(
+                options.requests,
+                options.concurrency,
+                lambda number: http.get(server.url + "/documents", headers=headers),
+            )
+            first_page_probes = await server.read_probes(http)
+
+            pages: List[float] = []
+            cursor = None
+            started = time.perf_counter()
+            while True:
+                page_started = time.perf_counter()
+                response = await http.get(
+                    server.url + "/documents",
+                    params={"cursor": cursor} if cursor else None,
+                    headers=headers,
+                )
+                response.raise_for_status()
+                pages.append(time.perf_counter() - page_started)
+                cursor = response.headers.get("X-Next-Cursor")
+                if cursor is None:
+                    break
+            report[str(count)] = {
+                "first_page": {**first_page.report(), "server": first_page_probes},
+                "walk": {
+                    "pages": len(pages),
+                    "total_ms": round((time.perf_counter() - started) * 1000, 3),
+                    "page_latency": summarize(pages),
+                },
+            }
+    return report
+
+
+async def fetch(server: Server, options: argparse.Namespace) -> dict:
+    """
+    Opening documents of different sizes, both cold and revalidating a
+    copy the client already has.
+    """
+    owner, = seed.create_users("fetch", 1)
+    report = {}
+    async with client(options.concurrency) as http:
+        token = await login(http, server, seed.email("fetch", 0), seed.PASSWORD)
+        headers = {"Authorization": f"Bearer {token}"}
+        for size in options.sizes:
+            document_id, = seed.create_documents(owner, 1, size)
+            url = f"{server.url}/documents/{document_id}"
+            await server.reset_probes(http)
+            full = await run_load(options.requests, options.concurrency, lambda number: http.get(url, headers=headers))
+            full_probes = await server.read_probes(http)
+
+            etag = (await http.get(url, headers=headers)).headers.get("ETag")
+            await server.reset_probes(http)
+            revalidated = await run_load(
+                options.requests,
+                options.concurrency,
+                lambda number: http.get(url, headers={**headers, "If-None-Match": etag or ""}),
+            )
+            report[str(size)] = {
+                "full": {**full.report(), "server": full_probes},
+                "revalidated": {**revalidated.report(), "server": await server.read_probes(http)},
+            }
+    return report
+
+
+async def rooms(server: Server, options: argparse.Namespace) -> dict:
+    """
+    Rooms of editors typing at a steady rate. Measures how long a keystroke
+    takes to be acknowledged to its sender and to reach everyone else in
+    the room.
+    """
+    owner, = seed.create_users("rooms", 1)
+    document_ids = seed.create_documents(owner, options.rooms, 2000)
+    acks: List[float] = []
+    fan_out: List[float] = []
+    sent: Dict[str, float] = {}
+    counts = {"keystrokes": 0, "deliveries": 0, "resyncs": 0, "errors": 0, "snapshots": 0}
+
+    async with client(4) as http:
+        token = await login(http, server, seed.email("rooms", 0), seed.PASSWORD)
+
+        async def editor(document_id: int, index: int, start_at: float, stop_at: float):
+            url = f"{server.ws_url}/ws/{document_id}?token={token}"
+            async with websockets.connect(url, max_size=None) as ws:
+                rev = json.loads(await ws.recv())["rev"]
+                # Send times of our keystrokes not acknowledged yet, in order
+                unacked: Deque[float] = deque()
+
+                async def receive():
+                    nonlocal rev
+                    async for raw in ws:
+                        now = time.perf_counter()
+                        message = json.loads(raw)
+                        kind = message["type"]
+                        if kind == "ack":
+                            rev = max(rev, message["rev"])
+                            if unacked:
+                                acks.append(now - unacked.popleft())
+                        elif kind == "delta":
+                            rev = max(rev, message["rev"])
+                            for op in message["ops"]:
+                                for marker in _MARKER.findall(op.get("insert", "")):
+                                    if marker in sent:
+                                        fan_out.append(now - sent[marker])
+                                        counts["deliveries"] += 1
+                        elif kind == "resync":
+                            counts["resyncs"] += 1
+                            await ws.send(json.dumps({"type": "sync", "rev": rev}))
+                        elif kind in ("catchup", "snapshot"):
+                            # Whatever was in flight is accounted for in here
+                            if kind == "snapshot":
+                                counts["snapshots"] += 1
+                            rev = message["rev"]
+                            unacked.clear()
+                        elif kind == "error":
+                            counts["errors"] += 1
+
+                receiver = asyncio.create_task(receive())
+                interval = 1 / options.keystrokes_per_second
+                # Spread the editors over one interval so they don't type in lockstep
+                next_at = start_at + random.random() * interval
+                number = 0
+                while True:
+                    await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+                    if time.perf_counter() >= stop_at:
+                        break
+                    marker = f"k{document_id}.{index}.{number}"
+                    sent[marker] = time.perf_counter()
+                    unacked.append(sent[marker])
+                    await ws.send(json.dumps({"type": "delta", "rev": rev, "ops": [{"insert": f"<{marker}>"}]}))
+                    counts["keystrokes"] += 1
+                    number += 1
+                    next_at += interval
+                # Let the last keystrokes arrive before hanging up
+                await asyncio.sleep(1)
+                receiver.cancel()
+
+        await server.reset_probes(http)
+        start_at = time.perf_counter() + 1
+        stop_at = start_at + options.duration
+        await asyncio.gather(*(
+            editor(document_id, index, start_at, stop_at)
+            for document_id in document_ids
+            for index in range(options.editors)
+        ))
+        expected = counts["keystrokes"] * (options.editors - 1)
+        return {
+            **counts,
+            "rooms": options.rooms,
+            "editors_per_room": options.editors,
+            "keystrokes_per_second": round(counts["keystrokes"] / options.duration, 2),
+            "delivered_fraction": round(counts["deliveries"] / expected, 4) if expected else 1.0,
+            "ack_latency": summarize(acks),
+            "fan_out_latency": summarize(fan_out),
+            "server": await server.read_probes(http),
+        }
+
+
+SCENARIOS = {
+    "login": login_storm,
+    "listing": listing,
+    "fetch": fetch,
+    "rooms": rooms,
+}
@@ -0,0 +1,88 @@
+"""
+Test data written straight into the benchmark database, much faster than
+going through the API. Importing this module connects to DATABASE_URL, so
+the harness imports it only once that points at its temporary database.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import List, Sequence
+
+from db_models import Document, User, UserDocumentAssociation, WriteSessionLocal
+from utils import content_store
+from utils.auth_helps import pwd_context
+from utils.search import index_documents
+
+PASSWORD = "benchmark"
+
+_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+
+
+def create_users(prefix: str, count: int) -> List[int]:
+    """
+    Users {prefix}-0@bench … {prefix}-{count-1}@bench, all with PASSWORD.
+    Returns their ids.
+    """
+    # One hash for everyone; hashing is what the login storm measures, not seeding
+    hashed = pwd_context.hash(PASSWORD)
+    db = WriteSessionLocal()
+    try:
+        users = [User(email=email(prefix, index), password=hashed) for index in range(count)]
+        db.add_all(users)
+        db.commit()
+        return [user.id for user in users]
+    finally:
+        db.close()
+
+
+def create_documents(owner_id: int, count: int, size: int, shared_with: Sequence[int] = ()) -> List[int]:
+    """
+    Documents of about `size` bytes of editor HTML, modified over the last
+    `count` minutes, optionally shared with other users for writing.
+    """
+    generator = random.Random(owner_id)
+    now = datetime.utcnow()
+    db = WriteSessionLocal()
+    try:
+        contents = [content_store.prepare(html_content(generator, size)) for _ in range(count)]
+        documents = [
+            Document(
+                owner_id=owner_id,
+                title=f"Benchmark document {index}",
+                content_manifest=content_store.dump_manifest(prepared.manifest),
+                last_modified=now - timedelta(minutes=index),
+            )
+            for index, prepared in enumerate(contents)
+        ]
+        db.add_all(documents)
+        db.flush()
+        index_documents(db, [
+            (document.id, document.title, prepared.stored) for document, prepared in zip(documents, contents)
+        ])
+        for document, prepared in zip(documents, contents):
+            content_store.store(db, prepared)
+            for user_id in shared_with:
+                db.add(UserDocumentAssociation(
+                    user_id=user_id, document_id=document.id, permission="write", last_modified=document.last_modified
+                ))
+        db.commit()
+        return [document.id for document in documents]
+    finally:
+        db.close()
+
+
+def email(prefix: str, index: int) -> str:
+    return f"{prefix}-{index}@bench"
+
+
+def html_content(generator: random.Random, size: int) -> str:
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = "<p>" + " ".join(generator.choice(_WORDS) for _ in range(40)) + "</p>"
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return "".join(paragraphs)[:size]
@@ -0,0 +1,70 @@
+"""
+The app from main.py with the probes the benchmarks read: event loop lag
+and database commits, reset and read over /__bench__/. Started by the
+harness; never deploy it.
+"""
+import asyncio
+import threading
+import time
+from typing import List, Optional
+
+from benchmarks.stats import summarize
+from db_models import write_engine
+from main import app
+from sqlalchemy import event
+
+# How often the lag probe wakes up; how late it does so is the loop lag
+LAG_PROBE_INTERVAL_SECONDS = 0.01
+
+
+class _Probes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.commits = 0
+            self.lags: List[float] = []
+
+
+probes = _Probes()
+
+
+@event.listens_for(write_engine, "commit")
+def _count_commit(connection):
+    # Every write goes through this engine; commits happen in the threadpool
+    with probes.lock:
+        probes.commits += 1
+
+
+async def _measure_lag():
+    while True:
+        before = time.monotonic()
+        await asyncio.sleep(LAG_PROBE_INTERVAL_SECONDS)
+        probes.lags.append(max(0.0, time.monotonic() - before - LAG_PROBE_INTERVAL_SECONDS))
+
+
+@app.post("/__bench__/reset")
+async def reset_probes():
+    # Started here rather than at startup so the app's own lifespan is untouched
+    if probes.task is None:
+        probes.task = asyncio.create_task(_measure_lag())
+    probes.reset()
+    return {"status": "success"}
+
+
+@app.get("/__bench__/stats")
+async def read_probes():
+    with probes.lock:
+        elapsed = time.monotonic() - probes.started
+        commits = probes.commits
+        lags = list(probes.lags)
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "commits": commits,
+        "commits_per_second": round(commits / elapsed, 2) if elapsed else 0.0,
+        "loop_lag": summarize(lags),
+    }
@@ -1,26 +1,85 @@
+import logging
+import os
 from datetime import datetime
+from typing import Optional
 
 from sqlalchemy import (
     CheckConstraint,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     Text,
     create_engine,
+    event,
+    func,
+    inspect,
+    text,
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./documents.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./documents.db")
+# Read connections kept open; with WAL they never wait on the writer
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+# How long a connection waits for a lock held by another process before failing
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# NORMAL is safe with WAL: a power loss can drop the last commits, never corrupt
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Bytes of the database file read through a memory map instead of read() calls
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Page cache per connection, in KiB
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(16 * 1024)))
+
+_is_sqlite = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+# Reads go through a pool, writes through a single connection so that this
+# process never has two write transactions waiting on each other
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
-    pool_size=5,
-    max_overflow=10,
+    pool_size=SQLITE_READ_POOL_SIZE,
+    max_overflow=SQLITE_READ_POOL_SIZE,
+    pool_timeout=30,
+)
+write_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    pool_size=1,
+    max_overflow=0,
     pool_timeout=30,
-    pool_pre_ping=True
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=write_engine)
+
+
+def _configure_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+
+
+def _configure_writer(dbapi_connection, connection_record):
+    # Let SQLAlchemy decide when transactions start, see _begin_immediate
+    dbapi_connection.isolation_level = None
+
+
+def _begin_immediate(connection):
+    # Take the write lock up front: a transaction that reads first and then
+    # tries to write can fail outright if another process wrote in between,
+    # while waiting for the lock here is covered by busy_timeout
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+if _is_sqlite:
+    event.listen(engine, "connect", _configure_connection)
+    event.listen(write_engine, "connect", _configure_connection)
+    event.listen(write_engine, "connect", _configure_writer)
+    event.listen(write_engine, "begin", _begin_immediate)
 
 class Base(DeclarativeBase):
     pass
@@ -31,9 +90,16 @@ SHARING_PERMISSIONS = ["read", "write", "owner"]
 # Document model
 class Document(Base):
     __tablename__ = "documents"    
+    __table_args__ = (
+        # Lists a user's documents newest first without sorting them
+        Index("ix_documents_owner_last_modified", "owner_id", "last_modified", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     owner_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+    # Only for documents saved before chunked storage; see utils/content_store.py
     content: Mapped[str] = mapped_column(Text, default="")
+    # JSON list of the hashes of the content's chunks, NULL until chunked
+    content_manifest: Mapped[Optional[str]] = mapped_column(Text, default="[]")
     title: Mapped[str] = mapped_column(String, default="Untitled Document")
     last_modified: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.utcnow
@@ -46,20 +112,138 @@ class User(Base):
     email: Mapped[str] = mapped_column(String, unique=True)
     password: Mapped[str] = mapped_column(String)
 
+# Case insensitive prefix search over addresses, see utils/user_directory.py
+Index("ix_users_email_lower", func.lower(User.email))
+
 class UserDocumentAssociation(Base):
     __tablename__ = "user_document_association"
+    __table_args__ = (
+        # A user has one permission per document; also serves "shared with me"
+        Index("ix_user_document_association_user_document", "user_id", "document_id", unique=True),
+        # Lists the documents shared with a user newest first without sorting them
+        Index("ix_user_document_association_user_last_modified", "user_id", "last_modified", "document_id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
-    document_id: Mapped[int] = mapped_column(Integer, ForeignKey("documents.id"))
+    document_id: Mapped[int] = mapped_column(Integer, ForeignKey("documents.id"), index=True)
     permission: Mapped[str] = mapped_column(String, CheckConstraint(f"permission IN {tuple(SHARING_PERMISSIONS)}"))
+    # Copy of the document's, kept current by save_document() in utils/document_store.py
+    last_modified: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+
+class DocumentRevision(Base):
+    """
+    One saved version of a document's content; see utils/revisions.py.
+    """
+    __tablename__ = "document_revisions"
+    __table_args__ = (
+        Index("ix_document_revisions_document_number", "document_id", "number", unique=True),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    document_id: Mapped[int] = mapped_column(Integer, ForeignKey("documents.id"), nullable=False)
+    # Counts up from 1 per document; compaction leaves gaps
+    number: Mapped[int] = mapped_column(Integer, nullable=False)
+    # "snapshot" (compressed content) or "delta" (compressed ops against the previous revision)
+    kind: Mapped[str] = mapped_column(String, CheckConstraint("kind IN ('snapshot', 'delta')"), nullable=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    title: Mapped[str] = mapped_column(String)
+    # Length of the content at this revision, as stored (images as references)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class ContentChunk(Base):
+    """
+    A piece of document content, shared by every document and version that
+    contains it; see utils/content_store.py.
+    """
+    __tablename__ = "content_chunks"
+    # blake2b of the uncompressed text
+    hash: Mapped[str] = mapped_column(String, primary_key=True)
+    # zlib compressed UTF-8
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Last stored or reused by a save; the garbage collector spares recent ones
+    last_used_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class ContentBlob(Base):
+    """
+    An image taken out of document content, stored once however many
+    documents contain it.
+    """
+    __tablename__ = "content_blobs"
+    # blake2b of the mime type and the bytes
+    hash: Mapped[str] = mapped_column(String, primary_key=True)
+    mime: Mapped[str] = mapped_column(String, nullable=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_used_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+def init_db():
+    """
+    Create missing tables and bring existing ones up to date with the
+    indexes declared above, which create_all leaves alone on old tables.
+    Runs in one write transaction, so workers starting together take turns.
+    """
+    with write_engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        columns = {column["name"] for column in inspect(connection).get_columns(Document.__tablename__)}
+        if "content_manifest" not in columns:
+            # Existing documents keep their content inline until they are next saved
+            connection.execute(text("ALTER TABLE documents ADD COLUMN content_manifest TEXT"))
+        columns = {column["name"] for column in inspect(connection).get_columns(UserDocumentAssociation.__tablename__)}
+        if "last_modified" not in columns:
+            connection.execute(text("ALTER TABLE user_document_association ADD COLUMN last_modified DATETIME"))
+            connection.execute(text(
+                "UPDATE user_document_association SET last_modified = "
+                "(SELECT last_modified FROM documents WHERE documents.id = user_document_association.document_id)"
+            ))
+        existing = {index["name"] for index in inspect(connection).get_indexes(UserDocumentAssociation.__tablename__)}
+        if "ix_user_document_association_user_document" not in existing:
+            # Repeated shares used to add a row each time; the latest one wins
+            connection.execute(text(
+                "DELETE FROM user_document_association WHERE id NOT IN ("
+                "SELECT MAX(id) FROM user_document_association GROUP BY user_id, document_id)"
+            ))
+        # By name: reflection, which checkfirst relies on, skips expression indexes
+        indexes = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(bind=connection)
+        # Full-text index over titles and content, kept up by utils/search.py;
+        # the prefix index keeps search-as-you-type on short prefixes cheap
+        if not inspect(connection).has_table("documents_fts"):
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE documents_fts USING fts5("
+                "title, body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            ))
+            if connection.execute(text("SELECT EXISTS (SELECT 1 FROM documents)")).scalar():
+                logging.getLogger(__name__).warning(
+                    "Search index created empty; run `python manage.py rebuild-search-index` to fill it"
+                )
 
 
 # Create tables
-Base.metadata.create_all(bind=engine)
+init_db()
 
+# Request scoped sessions; these dependencies are the only place they are closed
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def get_write_db():
+    """
+    For handlers that write: everything they do, reads included, runs on the
+    writer connection in one transaction.
+    """
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
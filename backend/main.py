@@ -1,24 +1,58 @@
 import json
-from datetime import datetime
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from db_models import Document, SessionLocal
+from db_models import SessionLocal
 from fastapi import (
     FastAPI,
-    Request,
     WebSocket,
     WebSocketDisconnect,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse
 from routes.auth import router as auth_router
 from routes.documents import router as documents_router
+from routes.revisions import router as revisions_router
 from routes.users import router as users_router
-from starlette.middleware.base import BaseHTTPMiddleware
-from utils.auth_helps import authorized_view, get_current_user_ws
-from utils.connection_manager import ConnectionManager
+from utils.auth_helps import get_current_user_ws
+from utils import collab
+from utils.broadcast import broadcast_backend
+from utils.collab import handle_message, join_snapshot
+from utils.connection_manager import manager
+from utils.document_store import document_store
+from utils import metrics
+from utils.log import configure as configure_logging, log_event
+from utils.permissions import ConnectionPermissions, access_level
+from utils.presence import presence
 
-app = FastAPI()
+# Responses smaller than this many bytes are sent uncompressed
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+# Fraction of incoming websocket messages logged at DEBUG; every keystroke is one
+WS_MESSAGE_LOG_SAMPLE_RATE = float(os.getenv("WS_MESSAGE_LOG_SAMPLE_RATE", "0.01"))
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await broadcast_backend.start(collab.on_room_message, collab.on_backend_reset)
+    await document_store.start()
+    await presence.start()
+    yield
+    await presence.stop()
+    # Persist every pending edit before the process goes away
+    await document_store.stop()
+    await broadcast_backend.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(documents_router)
+app.include_router(revisions_router)
 app.include_router(auth_router)
 app.include_router(users_router)
 
@@ -28,68 +62,74 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods (GET, POST, etc.)
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "ETag"],  # Lets the dashboard follow the document list's pages and the editor revalidate
 )
+# Document content and long lists compress several times over
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+app.add_middleware(metrics.RequestMetricsMiddleware)
 
-class DBConnectionMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        if hasattr(request.state, 'db'):
-            request.state.db.close()
-        return response
-
-app.add_middleware(DBConnectionMiddleware)
-
-manager = ConnectionManager()
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    # Runs on the event loop, where the state the gauges read is changed
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.websocket("/ws/{document_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
-    document_id: int
+    document_id: int,
+    # ETag of a copy the client already has, from GET /documents/{document_id}
+    etag: Optional[str] = None,
 ):
     # Get a fresh DB session for authentication
     db = SessionLocal()
     try:
         # Authenticate user before accepting connection
         current_user = await get_current_user_ws(websocket, db)
-        if not authorized_view(current_user, document_id, db):
-            print("User", current_user.email, "is not authorized to view document", document_id)
+        level = await run_in_threadpool(access_level, db, current_user.id, document_id)
+        access = ConnectionPermissions(current_user.id, document_id, level)
+        if not await access.allows("read"):
+            log_event(logger, logging.INFO, "ws.forbidden", user_id=current_user.id, document_id=document_id)
             await websocket.close(code=1008)
             return
     finally:
         db.close()
         
-    await manager.connect(websocket, str(document_id))
-    print("Connected to WebSocket for document", document_id, "with user", current_user.email)
+    state = await collab.join(document_id)
+    if state is None:
+        await websocket.close(code=1008)
+        return
+    peer = None
     try:
+        peer = await manager.connect(websocket, str(document_id))
+        log_event(logger, logging.INFO, "ws.connect", peer=peer.id, user_id=current_user.id, document_id=document_id)
+        await manager.send(websocket, str(document_id), await join_snapshot(state, etag))
+        await presence.join(peer, current_user.id, current_user.email)
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
-            print("Received message", message)
-            if message["type"] == "update":
-                # Get a fresh DB session for each update
-                db = SessionLocal()
-                try:
-                    # Update document in database
-                    document = db.query(Document).filter(Document.id == document_id).first()
-                    document.content = message["content"]
-                    if "title" in message:
-                        document.title = message["title"]
-                    document.last_modified = datetime.utcnow()
-                    db.commit()
-                    
-                    # Broadcast to all other clients
-                    await manager.broadcast(
-                        message,
-                        str(document_id),
-                        exclude=websocket
-                    )
-                finally:
-                    db.close()
-                
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await manager.send(websocket, str(document_id), {"type": "error", "detail": "Messages must be JSON objects"})
+                continue
+            log_event(
+                logger, logging.DEBUG, "ws.message", sample=WS_MESSAGE_LOG_SAMPLE_RATE,
+                peer=peer.id, type=message.get("type"), bytes=len(data),
+            )
+            # Edits go to the in-memory copy; the store writes it back in batches
+            await handle_message(peer, state, message, access)
+
     except WebSocketDisconnect:
-        await manager.disconnect(websocket, str(document_id))
+        log_event(logger, logging.INFO, "ws.disconnect", user_id=current_user.id, document_id=document_id)
     except RuntimeError:
+        pass
+    finally:
+        # Whatever ended the connection, its peer and writer task go with it
         await manager.disconnect(websocket, str(document_id))
+        if peer is not None:
+            presence.leave(peer)
+        await collab.leave(state)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,72 @@
+"""
+Maintenance commands, run from the backend directory:
+
+    python manage.py rebuild-search-index
+    python manage.py compact-revisions [--keep-days N]
+    python manage.py collect-content-garbage [--grace-seconds N]
+"""
+import argparse
+
+from db_models import WriteSessionLocal
+from utils.content_store import CONTENT_GC_GRACE_SECONDS, collect_garbage
+from utils.revisions import REVISION_KEEP_ALL_DAYS, compact_revisions
+from utils.search import rebuild_index
+
+
+def rebuild_search_index(args):
+    db = WriteSessionLocal()
+    try:
+        count = rebuild_index(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Indexed {count} documents")
+
+
+def compact(args):
+    db = WriteSessionLocal()
+    try:
+        documents, removed = compact_revisions(db, args.keep_days)
+    finally:
+        db.close()
+    print(f"Removed {removed} revisions from {documents} documents")
+
+
+def collect_content_garbage(args):
+    db = WriteSessionLocal()
+    try:
+        chunks, blobs = collect_garbage(db, args.grace_seconds)
+    finally:
+        db.close()
+    print(f"Removed {chunks} content chunks and {blobs} images")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="2note maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-search-index", help="reindex every document for full-text search")
+    rebuild.set_defaults(handler=rebuild_search_index)
+
+    compaction = commands.add_parser("compact-revisions", help="thin old revisions to one a day")
+    compaction.add_argument(
+        "--keep-days", type=float, default=REVISION_KEEP_ALL_DAYS,
+        help="keep every revision newer than this many days (default %(default)s)",
+    )
+    compaction.set_defaults(handler=compact)
+
+    garbage = commands.add_parser(
+        "collect-content-garbage", help="remove stored content and images no document or revision uses"
+    )
+    garbage.add_argument(
+        "--grace-seconds", type=float, default=CONTENT_GC_GRACE_SECONDS,
+        help="keep anything used more recently than this (default %(default)s)",
+    )
+    garbage.set_defaults(handler=collect_content_garbage)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
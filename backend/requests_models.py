@@ -1,4 +1,11 @@
-from pydantic import BaseModel
+from typing import List
+
+from pydantic import BaseModel, Field
+
+# Most documents one batch request may act on
+BATCH_MAX_DOCUMENTS = 100
+# Most people one batch share may reach
+BATCH_MAX_EMAILS = 1000
 
 
 class RegisterUserRequest(BaseModel):
@@ -15,4 +22,14 @@ class DocumentCreate(BaseModel):
 class ShareRequest(BaseModel):
     email: str
     permission: str = "write"
-    document_id: int
\ No newline at end of file
+    document_id: int
+class BatchShareRequest(BaseModel):
+    document_ids: List[int] = Field(min_length=1, max_length=BATCH_MAX_DOCUMENTS)
+    emails: List[str] = Field(min_length=1, max_length=BATCH_MAX_EMAILS)
+    permission: str = "write"
+
+class BatchDeleteRequest(BaseModel):
+    document_ids: List[int] = Field(min_length=1, max_length=BATCH_MAX_DOCUMENTS)
+
+class BatchCreateRequest(BaseModel):
+    documents: List[DocumentCreate] = Field(min_length=1, max_length=BATCH_MAX_DOCUMENTS)
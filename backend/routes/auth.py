@@ -1,10 +1,11 @@
 from datetime import timedelta
+from typing import Optional
 
-from db_models import User, get_db
+from db_models import SessionLocal, User, WriteSessionLocal
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from requests_models import RegisterUserRequest
-from sqlalchemy.orm import Session
 from utils.auth_helps import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     create_access_token,
@@ -14,24 +15,25 @@ from utils.auth_helps import (
 
 router = APIRouter()
 
+# Both handlers are async so that waiting for bcrypt holds no threadpool
+# thread. Their database work goes to the threadpool in sessions of its own:
+# a request scoped session would keep its connection while bcrypt runs, and
+# a storm would take the whole pool
+
 # User registration
 @router.post("/register")
-async def register_user(request: RegisterUserRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == request.email.strip()).first()
-    if user:
+async def register_user(request: RegisterUserRequest):
+    # Hash before touching the database so the writer isn't held meanwhile
+    hashed_password = await get_password_hash(request.password)
+    if not await run_in_threadpool(_add_user, request.email, hashed_password):
         raise HTTPException(status_code=400, detail="Email already registered")
-    
-    hashed_password = get_password_hash(request.password)
-    new_user = User(email=request.email, password=hashed_password)
-    db.add(new_user)
-    db.commit()
     return {"status": "User created successfully"}
 
 # User login
 @router.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await run_in_threadpool(_find_user, form_data.username)
+    if not user or not await verify_password(form_data.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -44,3 +46,22 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+
+def _find_user(email: str) -> Optional[User]:
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.email == email).first()
+    finally:
+        db.close()
+
+
+def _add_user(email: str, hashed_password: str) -> bool:
+    db = WriteSessionLocal()
+    try:
+        if db.query(User).filter(User.email == email.strip()).first():
+            return False
+        db.add(User(email=email, password=hashed_password))
+        db.commit()
+        return True
+    finally:
+        db.close()
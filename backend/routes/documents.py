@@ -1,94 +1,350 @@
-from datetime import datetime
-from typing import Optional
+import heapq
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Iterator, List, Literal, Optional, Tuple
 
-from db_models import Document, User, UserDocumentAssociation, get_db
-from fastapi import APIRouter, Depends, HTTPException
-from requests_models import DocumentCreate, ShareRequest
+from anyio import from_thread
+from db_models import SHARING_PERMISSIONS, Document, User, UserDocumentAssociation, get_db, get_write_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from requests_models import BatchCreateRequest, BatchDeleteRequest, BatchShareRequest, DocumentCreate, ShareRequest
+from sqlalchemy import Select, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
+from utils import content_store
+from utils.auth_cache import Principal
 from utils.auth_helps import get_current_user
+from utils.collab import publish_deleted, replace_content
+from utils.cursors import decode_cursor, encode_cursor
+from utils.document_store import document_store
+from utils.permissions import access_levels, allows, owned, require, require_owner
+from utils.revisions import delete_revisions
+from utils.search import index_documents, remove_documents, search
 
 router = APIRouter(prefix='/documents')
 
+# Documents listed per page unless the client asks for another size
+DOCUMENTS_PAGE_SIZE = 50
+DOCUMENTS_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+# Rows per INSERT, well within SQLite's limit on bound parameters
+_UPSERT_ROWS = 500
+
+@router.get("/search")
+def search_documents(
+    response: Response,
+    q: str,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=DOCUMENTS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    Documents the user can see whose title or text matches `q`, best match
+    first, each with a snippet around the hits. Paged like the list.
+    """
+    try:
+        offset = max(int(cursor), 0) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    results = search(db, current_user.id, q, limit + 1, offset)
+    if len(results) > limit:
+        results = results[:limit]
+        response.headers["X-Next-Cursor"] = str(offset + limit)
+    return results
+
 @router.get("/{document_id}")
-async def get_document(document_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    document = db.query(Document).outerjoin(
-        UserDocumentAssociation, Document.id == UserDocumentAssociation.document_id
-    ).filter(
-        (UserDocumentAssociation.user_id == current_user.id) | (Document.owner_id == current_user.id),
-        Document.id == document_id
-    ).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    return {
+def get_document(
+    document_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    A document with its content. The ETag changes whenever the response
+    would, so a client that sends it back as If-None-Match gets an empty
+    304 while its copy is current.
+    """
+    require(db, current_user.id, document_id, "read")
+    document = db.execute(
+        select(Document.id, Document.content_manifest, Document.title, Document.last_modified)
+        .where(Document.id == document_id)
+    ).one()
+    content = None
+    manifest = content_store.load_manifest(document.content_manifest)
+    title, last_modified = document.title, document.last_modified
+
+    # An open document may have edits that are not written back yet
+    live = document_store.peek(document.id)
+    if live is not None:
+        content, title, last_modified = live.content, live.title, live.last_modified
+    elif manifest is None:
+        content = db.scalar(select(Document.content).where(Document.id == document_id)) or ""
+
+    if content is None:
+        # Known from the manifest, before any content is read
+        etag = f'"{content_store.manifest_etag(title, last_modified, manifest)}"'
+    else:
+        etag = f'"{content_store.content_etag(title, content, last_modified)}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True),
+        # Browsers may keep it, but must ask before every use
+        "Cache-Control": "private, no-cache",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if content is None and len(manifest) <= content_store.CHUNKS_PER_READ:
+        content = content_store.read(db, manifest, None)
+    body = {
         "id": document.id,
-        "content": document.content,
-        "title": document.title,
-        "lastModified": document.last_modified.isoformat()
+        "content": content,
+        "title": title,
+        "lastModified": last_modified.isoformat()
     }
+    if content is not None:
+        return JSONResponse(body, headers=headers)
+    # Large documents go out a few chunks at a time instead of being
+    # assembled in memory first
+    return StreamingResponse(
+        _stream_json(body, "content", content_store.stream(manifest)),
+        media_type="application/json",
+        headers=headers,
+    )
 
 @router.get("")
-async def get_documents(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    try:
-        documents = db.query(Document).outerjoin(
-            UserDocumentAssociation, Document.id == UserDocumentAssociation.document_id
-        ).filter(
-            (UserDocumentAssociation.user_id == current_user.id) | (Document.owner_id == current_user.id)
-        ).order_by(Document.last_modified.desc()).all()
-        response = []
-        for document in documents:
-            response.append({
-                "id": document.id,
-                "title": document.title,
-                "lastModified": document.last_modified.isoformat(),
-                "owned_by_current_user": document.owner_id == current_user.id
-            })
-        return response
-    finally:
-        db.close()
+def get_documents(
+    response: Response,
+    limit: int = Query(DOCUMENTS_PAGE_SIZE, ge=1, le=DOCUMENTS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    filter: Optional[Literal["owned", "shared"]] = None,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    The user's documents, most recently modified first, a page at a time.
+    When there are more, X-Next-Cursor holds the cursor for the next page.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    columns = (Document.id, Document.title, Document.last_modified, Document.owner_id)
+    pages = []
+    if filter != "shared":
+        pages.append(_page(
+            select(*columns).where(Document.owner_id == current_user.id),
+            after, limit,
+        ))
+    if filter != "owned":
+        # Documents shared with the user that they also own are listed as owned.
+        # Ordered by the share's copy of last_modified, so that this is a range
+        # scan of the user's shares too
+        pages.append(_page(
+            select(*columns).select_from(UserDocumentAssociation).join(
+                Document, UserDocumentAssociation.document_id == Document.id
+            ).where(
+                UserDocumentAssociation.user_id == current_user.id,
+                Document.owner_id != current_user.id,
+            ),
+            after, limit,
+            UserDocumentAssociation.last_modified, UserDocumentAssociation.document_id,
+        ))
+    rows = list(heapq.merge(*(db.execute(page).all() for page in pages), key=_sort_key, reverse=True))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.last_modified.isoformat(), last.id)
+    return [
+        {
+            "id": row.id,
+            "title": row.title,
+            "lastModified": row.last_modified.isoformat(),
+            "owned_by_current_user": row.owner_id == current_user.id
+        }
+        for row in rows
+    ]
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match compares weakly, so W/ prefixes added by proxies still match
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
 
 
+def _stream_json(body: dict, key: str, pieces: Iterator[str]) -> Iterator[str]:
+    # `body` with its `key` string made up of `pieces`
+    head, tail = json.dumps({**body, key: ""}).split(f'"{key}": ""')
+    yield head + f'"{key}": "'
+    for piece in pieces:
+        # The piece as a JSON string, without its quotes
+        yield json.dumps(piece)[1:-1]
+    yield '"' + tail
+
+
+def _page(
+    query: Select,
+    after: Optional[Tuple[datetime, int]],
+    limit: int,
+    last_modified=Document.last_modified,
+    document_id=Document.id,
+) -> Select:
+    # One more than asked for tells us whether there is a next page
+    if after is not None:
+        query = query.where(tuple_(last_modified, document_id) < tuple_(*after))
+    return query.order_by(last_modified.desc(), document_id.desc()).limit(limit + 1)
+
+
+def _sort_key(row) -> Tuple[datetime, int]:
+    return row.last_modified, row.id
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        return decode_cursor(cursor, datetime.fromisoformat, int)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
 @router.post("")
-async def create_document(document: DocumentCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    new_document = Document(owner_id=current_user.id, title=document.title)
-    db.add(new_document)
+def create_document(document: DocumentCreate, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    new_document, = _create_documents(db, current_user.id, [document])
     db.commit()
-    return {"title": new_document.title, "id": new_document.id, "owner_id": new_document.owner_id, "last_modified": new_document.last_modified}
+    return _created(new_document)
 
-@router.put("/{document_id}")
-async def update_document(document_id: str, content: str, title: Optional[str] = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    document = db.query(Document).join(User).filter(Document.id == document_id, User.id == current_user.id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    document.content = content
-    if title:
-        document.title = title
-    document.last_modified = datetime.utcnow()
+@router.post("/batch")
+def create_documents(request: BatchCreateRequest, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    """
+    Create several documents at once; returns them in the order asked for.
+    """
+    documents = _create_documents(db, current_user.id, request.documents)
     db.commit()
-    
+    return [_created(document) for document in documents]
+
+@router.put("/{document_id}")
+def update_document(document_id: int, content: str, title: Optional[str] = None, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    require(db, current_user.id, document_id, "write")
+    document = db.get(Document, document_id)
+
+    # Go through the live copies so the next flush doesn't overwrite this update
+    replace_content(db, document, content, title or None)
     return {"status": "success"}
 
 @router.delete("/{document_id}")
-async def delete_document(document_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    document = db.query(Document).join(User).filter(Document.id == document_id, User.id == current_user.id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    db.delete(document)
+def delete_document(document_id: int, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    require_owner(db, current_user.id, document_id)
+    _delete_documents(db, [document_id])
     db.commit()
+    from_thread.run(publish_deleted, document_id)
     return {"status": "success"}
 
+@router.post("/batch/delete")
+def delete_documents(request: BatchDeleteRequest, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    """
+    Delete the user's documents among `document_ids`, with one result per
+    id; the others are reported as not found, like single deletes.
+    """
+    document_ids = list(dict.fromkeys(request.document_ids))
+    owned_ids = owned(db, current_user.id, document_ids)
+    deleted = [document_id for document_id in document_ids if document_id in owned_ids]
+    _delete_documents(db, deleted)
+    db.commit()
+    for document_id in deleted:
+        from_thread.run(publish_deleted, document_id)
+    return [
+        {"id": document_id, "status": "success"} if document_id in deleted
+        else {"id": document_id, "status": "error", "detail": "Document not found"}
+        for document_id in document_ids
+    ]
+
 @router.post("/share")
-async def share_document( share_request: ShareRequest, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def share_document( share_request: ShareRequest, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
     if current_user.email == share_request.email:
         raise HTTPException(status_code=400, detail="Cannot share document with yourself")
-    document = db.query(Document).join(User).filter(Document.id == share_request.document_id, User.id == current_user.id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
+    _check_permission(share_request.permission)
+    require(db, current_user.id, share_request.document_id, "owner")
     user = db.query(User).filter(User.email == share_request.email.strip()).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    db.add(UserDocumentAssociation(user_id=user.id, document_id=document.id, permission=share_request.permission))
+    _upsert_shares(db, [{"user_id": user.id, "document_id": share_request.document_id, "permission": share_request.permission}])
     db.commit()
-    return {"status": "success"}
\ No newline at end of file
+    return {"status": "success"}
+
+@router.post("/share/batch")
+def share_documents(request: BatchShareRequest, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    """
+    Share every document in `document_ids` with every address in `emails`,
+    with one result per document and address. The shares that can be made
+    are, whatever happens to the rest.
+    """
+    _check_permission(request.permission)
+    document_ids = list(dict.fromkeys(request.document_ids))
+    emails = list(dict.fromkeys(email.strip() for email in request.emails))
+    levels = access_levels(db, current_user.id, document_ids)
+    users = dict(db.execute(select(User.email, User.id).where(User.email.in_(emails))).all())
+    shares = []
+    results = []
+    for document_id in document_ids:
+        for email in emails:
+            if not allows(levels.get(document_id), "owner"):
+                detail = "Document not found"
+            elif email == current_user.email:
+                detail = "Cannot share document with yourself"
+            elif email not in users:
+                detail = "User not found"
+            else:
+                shares.append({"user_id": users[email], "document_id": document_id, "permission": request.permission})
+                results.append({"document_id": document_id, "email": email, "status": "success"})
+                continue
+            results.append({"document_id": document_id, "email": email, "status": "error", "detail": detail})
+    _upsert_shares(db, shares)
+    db.commit()
+    return results
+
+
+def _create_documents(db: Session, owner_id: int, documents: List[DocumentCreate]) -> List[Document]:
+    new_documents = [Document(owner_id=owner_id, title=document.title) for document in documents]
+    db.add_all(new_documents)
+    db.flush()
+    index_documents(db, [(document.id, document.title, "") for document in new_documents])
+    return new_documents
+
+
+def _created(document: Document) -> dict:
+    return {"title": document.title, "id": document.id, "owner_id": document.owner_id, "last_modified": document.last_modified}
+
+
+def _delete_documents(db: Session, document_ids: List[int]):
+    if not document_ids:
+        return
+    # SQLite may hand the ids out again; their shares must not carry over
+    db.query(UserDocumentAssociation).filter(
+        UserDocumentAssociation.document_id.in_(document_ids)
+    ).delete(synchronize_session=False)
+    remove_documents(db, document_ids)
+    delete_revisions(db, document_ids)
+    db.query(Document).filter(Document.id.in_(document_ids)).delete(synchronize_session=False)
+
+
+def _check_permission(permission: str):
+    if permission not in SHARING_PERMISSIONS:
+        raise HTTPException(status_code=400, detail="Invalid permission")
+
+
+def _upsert_shares(db: Session, shares: List[dict]):
+    # Sharing again changes the permission, there is one per user and document
+    document_ids = {share["document_id"] for share in shares}
+    modified = dict(db.execute(
+        select(Document.id, Document.last_modified).where(Document.id.in_(document_ids))
+    ).all()) if document_ids else {}
+    shares = [{**share, "last_modified": modified.get(share["document_id"])} for share in shares]
+    for start in range(0, len(shares), _UPSERT_ROWS):
+        statement = sqlite_insert(UserDocumentAssociation).values(shares[start:start + _UPSERT_ROWS])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[UserDocumentAssociation.user_id, UserDocumentAssociation.document_id],
+            set_={"permission": statement.excluded.permission, "last_modified": statement.excluded.last_modified},
+        ))
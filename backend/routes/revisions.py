@@ -0,0 +1,72 @@
+from typing import Optional
+
+from db_models import Document, get_db, get_write_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy.orm import Session
+from utils import content_store
+from utils.auth_cache import Principal
+from utils.auth_helps import get_current_user
+from utils.collab import replace_content
+from utils.permissions import require
+from utils.revisions import get_revision, list_revisions
+
+router = APIRouter(prefix='/documents')
+
+# Revisions listed per page unless the client asks for another size
+REVISIONS_PAGE_SIZE = 50
+REVISIONS_MAX_PAGE_SIZE = 200
+
+@router.get("/{document_id}/revisions")
+def get_revisions(
+    document_id: int,
+    response: Response,
+    limit: int = Query(REVISIONS_PAGE_SIZE, ge=1, le=REVISIONS_MAX_PAGE_SIZE),
+    cursor: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    A document's revisions, newest first. When there are more,
+    X-Next-Cursor holds the cursor for the next page.
+    """
+    require(db, current_user.id, document_id, "read")
+    revisions = list_revisions(db, document_id, cursor, limit + 1)
+    if len(revisions) > limit:
+        revisions = revisions[:limit]
+        response.headers["X-Next-Cursor"] = str(revisions[-1].number)
+    return [
+        {
+            "number": revision.number,
+            "title": revision.title,
+            "size": revision.size,
+            "createdAt": revision.created_at.isoformat(),
+        }
+        for revision in revisions
+    ]
+
+@router.get("/{document_id}/revisions/{number}")
+def get_document_revision(document_id: int, number: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    require(db, current_user.id, document_id, "read")
+    found = get_revision(db, document_id, number)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    revision, stored = found
+    content = content_store.inline(db, stored)
+    return {
+        "number": revision.number,
+        "title": revision.title,
+        "content": content,
+        "createdAt": revision.created_at.isoformat(),
+    }
+
+@router.post("/{document_id}/revisions/{number}/restore")
+def restore_revision(document_id: int, number: int, db: Session = Depends(get_write_db), current_user: Principal = Depends(get_current_user)):
+    require(db, current_user.id, document_id, "write")
+    found = get_revision(db, document_id, number)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    revision, stored = found
+    content = content_store.inline(db, stored)
+    # Restoring is a new save on top of the history, not a rewind of it
+    replace_content(db, db.get(Document, document_id), content, revision.title)
+    return {"status": "success"}
@@ -1,12 +1,52 @@
+from typing import Optional
 
-from db_models import User, get_db
-from fastapi import APIRouter, Depends
+from db_models import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
+from utils.auth_cache import Principal
 from utils.auth_helps import get_current_user
+from utils.user_directory import search_users
 
 router = APIRouter(prefix='/users')
 
+# Users returned per page unless the client asks for another size
+USERS_PAGE_SIZE = 10
+USERS_MAX_PAGE_SIZE = 50
+
 @router.get("")
-async def get_users(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = db.query(User).all()
-    return users
\ No newline at end of file
+def get_users(
+    response: Response,
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    Every user's id and email, a page at a time in address order.
+    """
+    return _page(response, db, "", limit, cursor)
+
+@router.get("/search")
+def search(
+    response: Response,
+    q: str = Query(min_length=1),
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    Users whose email starts with `q`, ignoring case, for typeahead. When
+    there are more, X-Next-Cursor holds the cursor for the next page.
+    """
+    return _page(response, db, q, limit, cursor)
+
+
+def _page(response: Response, db: Session, prefix: str, limit: int, cursor: Optional[str]):
+    try:
+        users, next_cursor = search_users(db, prefix, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return users
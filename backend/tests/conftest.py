@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Tests import the backend's modules the way main.py does
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Importing the models connects to DATABASE_URL, so point it somewhere
+# disposable before any test does; servers the tests start inherit it
+WORKDIR = tempfile.mkdtemp(prefix="2note-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{WORKDIR}/documents.db"
+os.environ["BROADCAST_SOCKET_PATH"] = os.path.join(WORKDIR, "broadcast.sock")
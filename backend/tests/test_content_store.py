@@ -0,0 +1,192 @@
+"""
+Chunked, deduplicated document content: what is saved must read back
+exactly, images included, however it was cut.
+"""
+import base64
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from db_models import ContentBlob, ContentChunk, Document, User, WriteSessionLocal
+from sqlalchemy import func, select
+from utils import content_store
+from utils.document_store import save_document
+
+
+@pytest.fixture
+def db():
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="module")
+def owner_id():
+    db = WriteSessionLocal()
+    try:
+        user = User(email="content-store@test", password="")
+        db.add(user)
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+
+def paragraphs(generator: random.Random, size: int) -> str:
+    words = ("lorem", "ipsum", "dolor", "sit", "amet", "élan", "naïve", "😀")
+    parts = []
+    length = 0
+    while length < size:
+        part = "<p>" + " ".join(generator.choice(words) for _ in range(generator.randint(5, 40))) + "</p>"
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def image(generator: random.Random, size: int = 6000) -> str:
+    return f'<img src="data:image/png;base64,{base64.b64encode(generator.randbytes(size)).decode()}">'
+
+
+def save(db, owner_id: int, content: str, document_id=None) -> int:
+    if document_id is None:
+        document = Document(owner_id=owner_id, title="Content", last_modified=datetime(2000, 1, 1))
+        db.add(document)
+        db.flush()
+        document_id = document.id
+    assert save_document(db, document_id, content, "Content", datetime.utcnow())
+    db.commit()
+    return document_id
+
+
+def manifest(db, document_id: int):
+    return content_store.load_manifest(db.scalar(select(Document.content_manifest).where(Document.id == document_id)))
+
+
+def assert_reads_back(db, document_id: int, content: str):
+    stored = manifest(db, document_id)
+    assert content_store.read(db, stored, None) == content
+    assert "".join(content_store.stream(stored)) == content
+
+
+def blob_count(db, blob_hash: str) -> int:
+    return db.scalar(select(func.count()).select_from(ContentBlob).where(ContentBlob.hash == blob_hash))
+
+
+def test_text_larger_than_a_chunk_round_trips(db, owner_id):
+    content = paragraphs(random.Random(1), 3 * content_store.CONTENT_CHUNK_MAX_CHARS)
+    document_id = save(db, owner_id, content)
+    assert len(manifest(db, document_id)) > content_store.CHUNKS_PER_READ
+    assert_reads_back(db, document_id, content)
+
+
+def test_images_round_trip_and_are_stored_apart(db, owner_id):
+    generator = random.Random(2)
+    content = paragraphs(generator, 100_000) + image(generator) + paragraphs(generator, 100_000) + image(generator)
+    document_id = save(db, owner_id, content)
+    prepared = content_store.prepare(content)
+    assert len(prepared.blobs) == 2
+    assert "base64" not in prepared.stored
+    for blob_hash in prepared.blobs:
+        assert blob_count(db, blob_hash) == 1
+    assert_reads_back(db, document_id, content)
+
+
+@pytest.mark.parametrize("padding", range(-40, 41, 8))
+def test_hard_cut_never_splits_an_image_reference(db, owner_id, padding):
+    # No block boundary before the image, so the chunk ends wherever it must
+    generator = random.Random(padding)
+    content = "<p>" + "a" * (content_store.CONTENT_CHUNK_MAX_CHARS - 16 + padding) + image(generator) + "</p>"
+    prepared = content_store.prepare(content)
+    for piece in content_store.split(prepared.stored):
+        assert piece.count("\ue002") == piece.count("\ue003")
+    document_id = save(db, owner_id, content)
+    (blob_hash,) = prepared.blobs
+    assert blob_count(db, blob_hash) == 1
+    assert_reads_back(db, document_id, content)
+
+
+def test_image_shared_by_documents_is_stored_once(db, owner_id):
+    generator = random.Random(3)
+    shared = image(generator)
+    first = paragraphs(generator, 10_000) + shared
+    second = shared + paragraphs(generator, 20_000)
+    first_id = save(db, owner_id, first)
+    second_id = save(db, owner_id, second)
+    (blob_hash,) = content_store.prepare(first).blobs
+    assert content_store.prepare(second).blobs.keys() == {blob_hash}
+    assert blob_count(db, blob_hash) == 1
+    assert_reads_back(db, first_id, first)
+    assert_reads_back(db, second_id, second)
+
+
+def test_small_edit_stores_only_the_chunks_it_touches(db, owner_id):
+    content = paragraphs(random.Random(4), 400_000)
+    document_id = save(db, owner_id, content)
+    before = set(manifest(db, document_id))
+    chunks_before = db.scalar(select(func.count()).select_from(ContentChunk))
+
+    middle = content.index("</p>", len(content) // 2)
+    edited = content[:middle] + " edited" + content[middle:]
+    save(db, owner_id, edited, document_id)
+
+    after = manifest(db, document_id)
+    assert len(set(after) - before) <= 2
+    assert db.scalar(select(func.count()).select_from(ContentChunk)) - chunks_before == len(set(after) - before)
+    assert_reads_back(db, document_id, edited)
+
+
+def test_stream_rebuilds_references_cut_across_chunk_groups(db, owner_id):
+    # What saves made before references were kept whole could leave behind
+    generator = random.Random(5)
+    content = paragraphs(generator, 1000) + image(generator) + paragraphs(generator, 1000)
+    prepared = content_store.prepare(content)
+    (blob_hash,) = prepared.blobs
+    cut = prepared.stored.index("\ue002") + 10
+    head, tail = prepared.stored[:cut], prepared.stored[cut:]
+    filler = [f"<p>{index}</p>" for index in range(content_store.CHUNKS_PER_READ - 1)]
+    pieces = filler + [head, tail]
+    legacy = content_store.PreparedContent(
+        stored="".join(pieces),
+        chunks=[(content_store._hash(piece.encode()), piece) for piece in pieces],
+        blobs=prepared.blobs,
+    )
+    content_store.store(db, legacy)
+    content_store._store_blobs(db, prepared.blobs, datetime.utcnow())
+    db.commit()
+    assert "".join(content_store.stream(legacy.manifest)) == "".join(filler) + content
+
+
+def test_garbage_collection_keeps_what_is_used_or_recent(db, owner_id):
+    generator = random.Random(6)
+    used = paragraphs(generator, 20_000) + image(generator)
+    used_id = save(db, owner_id, used)
+    # Stored but referenced by no document or revision
+    old = content_store.prepare(paragraphs(generator, 20_000) + image(generator))
+    recent = content_store.prepare(paragraphs(generator, 20_000) + image(generator))
+    content_store.store(db, old)
+    content_store.store(db, recent)
+    db.commit()
+
+    long_ago = datetime.utcnow() - timedelta(days=2)
+    used_prepared = content_store.prepare(used)
+    for prepared in (old, used_prepared):
+        db.query(ContentChunk).filter(ContentChunk.hash.in_(prepared.manifest)).update(
+            {ContentChunk.last_used_at: long_ago}, synchronize_session=False
+        )
+        db.query(ContentBlob).filter(ContentBlob.hash.in_(list(prepared.blobs))).update(
+            {ContentBlob.last_used_at: long_ago}, synchronize_session=False
+        )
+    db.commit()
+
+    chunks, blobs = content_store.collect_garbage(db, grace_seconds=3600)
+
+    assert chunks >= len(old.manifest) and blobs >= 1
+    stored_chunks = set(db.scalars(select(ContentChunk.hash)))
+    stored_blobs = set(db.scalars(select(ContentBlob.hash)))
+    assert not stored_chunks & set(old.manifest)
+    assert not stored_blobs & set(old.blobs)
+    assert set(recent.manifest) <= stored_chunks and set(recent.blobs) <= stored_blobs
+    assert set(used_prepared.manifest) <= stored_chunks and set(used_prepared.blobs) <= stored_blobs
+    assert_reads_back(db, used_id, used)
@@ -0,0 +1,59 @@
+"""
+Only a document's owner may delete it, whatever it was shared as.
+"""
+import pytest
+from db_models import Document, User, UserDocumentAssociation, WriteSessionLocal
+from fastapi.testclient import TestClient
+from utils.auth_helps import create_access_token
+
+
+@pytest.fixture(scope="module")
+def users():
+    db = WriteSessionLocal()
+    try:
+        owner = User(email="delete-owner@test", password="")
+        other = User(email="delete-shared@test", password="")
+        db.add_all([owner, other])
+        db.commit()
+        return owner.id, other.id
+    finally:
+        db.close()
+
+
+def shared_document(owner_id: int, user_id: int) -> int:
+    db = WriteSessionLocal()
+    try:
+        document = Document(owner_id=owner_id, title="Shared")
+        db.add(document)
+        db.flush()
+        db.add(UserDocumentAssociation(user_id=user_id, document_id=document.id, permission="owner"))
+        db.commit()
+        return document.id
+    finally:
+        db.close()
+
+
+def headers(email: str) -> dict:
+    return {"Authorization": f"Bearer {create_access_token({'sub': email})}"}
+
+
+def test_shared_owner_cannot_delete(users):
+    from main import app
+
+    owner_id, other_id = users
+    single = shared_document(owner_id, other_id)
+    batch = shared_document(owner_id, other_id)
+    with TestClient(app) as client:
+        assert client.delete(f"/documents/{single}", headers=headers("delete-shared@test")).status_code == 404
+        results = client.post(
+            "/documents/batch/delete", json={"document_ids": [batch]}, headers=headers("delete-shared@test")
+        ).json()
+        assert results == [{"id": batch, "status": "error", "detail": "Document not found"}]
+        assert client.get(f"/documents/{single}", headers=headers("delete-shared@test")).status_code == 200
+
+        assert client.delete(f"/documents/{single}", headers=headers("delete-owner@test")).status_code == 200
+        results = client.post(
+            "/documents/batch/delete", json={"document_ids": [batch]}, headers=headers("delete-owner@test")
+        ).json()
+        assert results == [{"id": batch, "status": "success"}]
+        assert client.get(f"/documents/{single}", headers=headers("delete-owner@test")).status_code == 404
@@ -0,0 +1,99 @@
+"""
+The operational transform every worker's copy of a document depends on.
+"""
+import random
+
+import pytest
+from utils import delta
+
+# Randomized cases per property; seeded so a failure can be replayed
+CASES = 2000
+ALPHABET = "ab\n<>é😀"
+
+
+def random_text(generator: random.Random, max_length: int = 12) -> str:
+    return "".join(generator.choice(ALPHABET) for _ in range(generator.randint(0, max_length)))
+
+
+def random_delta(generator: random.Random, text: str) -> list:
+    """
+    A valid delta against `text`: random retains, deletes and inserts,
+    normalized the way validate() returns client deltas.
+    """
+    ops = []
+    index = 0
+    while index < len(text) or generator.random() < 0.3:
+        kind = generator.choice(("retain", "delete", "insert"))
+        if kind == "insert":
+            ops.append({"insert": random_text(generator, 4) or "x"})
+        elif index < len(text):
+            length = generator.randint(1, len(text) - index)
+            ops.append({kind: length})
+            index += length
+        if generator.random() < 0.2:
+            break
+    return delta.validate(ops)
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_transform_converges(seed):
+    generator = random.Random(seed)
+    text = random_text(generator)
+    a = random_delta(generator, text)
+    b = random_delta(generator, text)
+    # Whichever was sequenced first, both sites end up with the same text
+    assert delta.apply(delta.apply(text, b), delta.transform(a, b, True)) == delta.apply(
+        delta.apply(text, a), delta.transform(b, a, False)
+    )
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_diff_round_trips(seed):
+    generator = random.Random(seed)
+    old = random_text(generator)
+    new = random_text(generator)
+    assert delta.apply(old, delta.diff(old, new)) == new
+
+
+def test_diff_of_equal_texts_is_empty():
+    assert delta.diff("same", "same") == []
+
+
+def test_diff_keeps_common_prefix_and_suffix():
+    assert delta.diff("hello world", "hello brave world") == [{"retain": 6}, {"insert": "brave "}]
+
+
+def test_validate_normalizes():
+    ops = [{"retain": 2}, {"retain": 1}, {"insert": ""}, {"delete": 1}, {"insert": "x"}, {"retain": 4}]
+    assert delta.validate(ops) == [{"retain": 3}, {"insert": "x"}, {"delete": 1}]
+
+
+@pytest.mark.parametrize("ops", [
+    None,
+    {"retain": 1},
+    [{"retain": -1}],
+    [{"retain": True}],
+    [{"delete": 1.5}],
+    [{"insert": 3}],
+    [{"retain": 1, "insert": "x"}],
+    [{"format": 1}],
+    ["insert"],
+])
+def test_validate_rejects_malformed_deltas(ops):
+    with pytest.raises(delta.DeltaError):
+        delta.validate(ops)
+
+
+@pytest.mark.parametrize("ops", [
+    [{"retain": 4}],
+    [{"retain": 2}, {"delete": 2}],
+    [{"delete": 4}],
+    [{"insert": "x"}, {"retain": 3}, {"delete": 1}],
+])
+def test_apply_rejects_ops_past_the_end(ops):
+    with pytest.raises(delta.DeltaError):
+        delta.apply("abc", ops)
+
+
+def test_apply_counts_code_points():
+    assert delta.apply("a😀b", [{"retain": 1}, {"delete": 1}, {"insert": "é"}]) == "aéb"
@@ -0,0 +1,54 @@
+"""
+Deleting a document ends every editing session on it.
+"""
+import pytest
+from db_models import Document, User, UserDocumentAssociation, WriteSessionLocal
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from utils.auth_helps import create_access_token
+from utils.broadcast import broadcast_backend
+from utils.collab import WS_4404_DOCUMENT_DELETED
+from utils.document_store import document_store
+
+
+@pytest.fixture(scope="module")
+def document_id():
+    db = WriteSessionLocal()
+    try:
+        owner = User(email="deleted-owner@test", password="")
+        editor = User(email="deleted-editor@test", password="")
+        db.add_all([owner, editor])
+        db.flush()
+        document = Document(owner_id=owner.id, title="Doomed")
+        db.add(document)
+        db.flush()
+        db.add(UserDocumentAssociation(user_id=editor.id, document_id=document.id, permission="write"))
+        db.commit()
+        return document.id
+    finally:
+        db.close()
+
+
+def token(email: str) -> str:
+    return create_access_token({"sub": email})
+
+
+def test_clients_are_disconnected_and_the_room_dropped(document_id):
+    from main import app
+
+    with TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{document_id}?token={token('deleted-owner@test')}") as owner, \
+                client.websocket_connect(f"/ws/{document_id}?token={token('deleted-editor@test')}") as editor:
+            assert owner.receive_json()["type"] == "snapshot"
+            assert editor.receive_json()["type"] == "snapshot"
+            response = client.delete(
+                f"/documents/{document_id}", headers={"Authorization": f"Bearer {token('deleted-owner@test')}"}
+            )
+            assert response.status_code == 200
+            for websocket in (owner, editor):
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    while True:
+                        websocket.receive_json()
+                assert closed.value.code == WS_4404_DOCUMENT_DELETED
+        assert document_store.peek(document_id) is None
+        assert str(document_id) not in broadcast_backend.rooms
@@ -0,0 +1,72 @@
+"""
+A login storm must leave the server answering: bcrypt runs in its own
+small pool, and waiting for it may hold neither the event loop nor the
+threadpool the other handlers run in.
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+from benchmarks.harness import Server
+from conftest import WORKDIR
+from passlib.hash import bcrypt
+
+# More logins at once than AnyIO's threadpool has threads (40), so handlers
+# that held a thread while waiting for bcrypt would take all of them
+LOGINS = 60
+# Cheaper than the default cost so the storm takes seconds, not minutes;
+# with one hashing thread it still queues for far longer than the bounds below
+BCRYPT_ROUNDS = 10
+MAX_LOOP_LAG_P99_MS = 100
+MAX_LISTING_SECONDS = 1.0
+PASSWORD = "storm"
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = Server(WORKDIR, env={"PASSWORD_HASH_WORKERS": "1"})
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_login_storm_leaves_server_responsive(server):
+    # Imported here: the models connect to DATABASE_URL, set in conftest
+    from db_models import User, WriteSessionLocal
+
+    hashed = bcrypt.using(rounds=BCRYPT_ROUNDS).hash(PASSWORD)
+    db = WriteSessionLocal()
+    try:
+        db.add_all([User(email=f"storm-{number}@test", password=hashed) for number in range(LOGINS)])
+        db.add(User(email="reader@test", password=hashed))
+        db.commit()
+    finally:
+        db.close()
+
+    async def run():
+        limits = httpx.Limits(max_connections=LOGINS + 10)
+        async with httpx.AsyncClient(base_url=server.url, limits=limits, timeout=120) as client:
+            response = await client.post("/token", data={"username": "reader@test", "password": PASSWORD})
+            response.raise_for_status()
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            await server.reset_probes(client)
+
+            storm = [
+                asyncio.create_task(client.post("/token", data={"username": f"storm-{number}@test", "password": PASSWORD}))
+                for number in range(LOGINS)
+            ]
+            # Let every login reach the server and queue for the hashing thread
+            await asyncio.sleep(0.5)
+            started = time.perf_counter()
+            listing = await client.get("/documents", headers=headers)
+            listing_seconds = time.perf_counter() - started
+            logins = await asyncio.gather(*storm)
+            return listing, listing_seconds, logins, await server.read_probes(client)
+
+    listing, listing_seconds, logins, probes = asyncio.run(run())
+
+    assert listing.status_code == 200
+    assert all(response.status_code == 200 for response in logins)
+    assert listing_seconds < MAX_LISTING_SECONDS, f"GET /documents took {listing_seconds:.2f}s during the storm"
+    assert probes["loop_lag"]["p99_ms"] < MAX_LOOP_LAG_P99_MS, probes["loop_lag"]
@@ -0,0 +1,158 @@
+"""
+Revision history stored as snapshots and deltas: every revision must
+rebuild to exactly what was saved, before and after compaction.
+"""
+import base64
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from db_models import Document, DocumentRevision, User, WriteSessionLocal
+from fastapi.testclient import TestClient
+from utils import revisions
+from utils.auth_helps import create_access_token
+from utils.content_store import prepare
+from utils.document_store import save_document
+
+INTERVAL = revisions.REVISION_SNAPSHOT_INTERVAL
+
+
+@pytest.fixture
+def db():
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="module")
+def owner():
+    db = WriteSessionLocal()
+    try:
+        user = User(email="revisions@test", password="")
+        db.add(user)
+        db.commit()
+        return user.id, user.email
+    finally:
+        db.close()
+
+
+def new_document(db, owner_id: int) -> int:
+    document = Document(owner_id=owner_id, title="History", last_modified=datetime(2000, 1, 1))
+    db.add(document)
+    db.commit()
+    return document.id
+
+
+def versions(generator: random.Random, count: int) -> list:
+    """
+    `count` successive contents, each a small random edit of the one before.
+    """
+    content = "<p>" + " ".join(generator.choice(("alpha", "beta", "gamma", "δέλτα")) for _ in range(200)) + "</p>"
+    result = []
+    for _ in range(count):
+        start = generator.randrange(len(content) + 1)
+        end = min(len(content), start + generator.randrange(20))
+        content = content[:start] + generator.choice(("", "new ", "<b>bold</b>", "😀")) + content[end:]
+        result.append(content)
+    return result
+
+
+def record(db, document_id: int, contents: list, times: list):
+    previous = None
+    for content, created_at in zip(contents, times):
+        revisions.record_revision(db, document_id, previous, content, "History", created_at)
+        # Each save adds its revision in a transaction of its own
+        db.commit()
+        previous = content
+
+
+def kinds(db, document_id: int) -> dict:
+    rows = db.query(DocumentRevision.number, DocumentRevision.kind).filter(DocumentRevision.document_id == document_id)
+    return dict(rows.all())
+
+
+def test_every_revision_rebuilds_across_snapshot_intervals(db, owner):
+    document_id = new_document(db, owner[0])
+    contents = versions(random.Random(1), 3 * INTERVAL + 5)
+    now = datetime.utcnow()
+    record(db, document_id, contents, [now] * len(contents))
+
+    stored = kinds(db, document_id)
+    assert sorted(number for number, kind in stored.items() if kind == revisions.SNAPSHOT) == [
+        1, INTERVAL + 1, 2 * INTERVAL + 1, 3 * INTERVAL + 1
+    ]
+    for number, content in enumerate(contents, start=1):
+        revision, rebuilt = revisions.get_revision(db, document_id, number)
+        assert revision.number == number
+        assert rebuilt == content
+    assert revisions.get_revision(db, document_id, len(contents) + 1) is None
+
+
+def test_compaction_keeps_the_last_revision_of_each_old_day(db, owner):
+    document_id = new_document(db, owner[0])
+    now = datetime.utcnow()
+    old_days = 2 * INTERVAL
+    times = []
+    for day in range(old_days, 0, -1):
+        start = datetime.combine((now - timedelta(days=7 + day)).date(), datetime.min.time())
+        times += [start + timedelta(hours=hour) for hour in (1, 9, 17)]
+    recent = INTERVAL + 3
+    times += [now - timedelta(minutes=recent - index) for index in range(recent)]
+    contents = versions(random.Random(2), len(times))
+    record(db, document_id, contents, times)
+
+    revisions.compact_revisions(db, keep_all_days=7)
+
+    # The last of each old day's three saves, then everything recent
+    expected = [3 * day for day in range(1, old_days + 1)] + list(range(3 * old_days + 1, len(contents) + 1))
+    stored = kinds(db, document_id)
+    assert sorted(stored) == expected
+    assert stored[expected[0]] == revisions.SNAPSHOT
+    # Still no more than an interval of deltas in a row
+    run = 0
+    for number in expected:
+        run = 0 if stored[number] == revisions.SNAPSHOT else run + 1
+        assert run < INTERVAL
+    for number, content in enumerate(contents, start=1):
+        found = revisions.get_revision(db, document_id, number)
+        if number in stored:
+            assert found[0].number == number
+            assert found[1] == content
+        else:
+            assert found is None
+    # A save after compaction carries on from the last number
+    revisions.record_revision(db, document_id, contents[-1], contents[-1] + "!", "History", now)
+    db.commit()
+    assert revisions.get_revision(db, document_id, len(contents) + 1)[1] == contents[-1] + "!"
+
+
+def test_revision_routes_page_over_gaps_and_put_images_back(db, owner):
+    from main import app
+
+    owner_id, email = owner
+    document_id = new_document(db, owner_id)
+    image = f'<img src="data:image/png;base64,{base64.b64encode(random.Random(3).randbytes(6000)).decode()}">'
+    contents = ["<p>one</p>", "<p>one</p>" + image, "<p>two</p>" + image, "<p>three</p>"]
+    # Two saves on the second day: compaction keeps only the later one
+    times = [datetime(2001, 1, 1), datetime(2001, 1, 2, 1), datetime(2001, 1, 2, 2), datetime(2001, 1, 3)]
+    for content, saved_at in zip(contents, times):
+        assert save_document(db, document_id, content, "History", saved_at)
+        db.commit()
+    # Revisions hold the content with the image taken out
+    assert "base64" not in revisions.get_revision(db, document_id, 3)[1]
+    assert prepare(contents[2]).stored == revisions.get_revision(db, document_id, 3)[1]
+    revisions.compact_revisions(db, keep_all_days=0)
+    assert sorted(kinds(db, document_id)) == [1, 3, 4]
+
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': email})}"}
+    with TestClient(app) as client:
+        first = client.get(f"/documents/{document_id}/revisions?limit=2", headers=headers)
+        assert [revision["number"] for revision in first.json()] == [4, 3]
+        rest = client.get(
+            f"/documents/{document_id}/revisions?limit=2&cursor={first.headers['x-next-cursor']}", headers=headers
+        )
+        assert [revision["number"] for revision in rest.json()] == [1]
+        assert client.get(f"/documents/{document_id}/revisions/3", headers=headers).json()["content"] == contents[2]
+        assert client.get(f"/documents/{document_id}/revisions/2", headers=headers).status_code == 404
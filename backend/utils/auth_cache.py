@@ -0,0 +1,62 @@
+"""
+Cache of verified access tokens, so authenticated requests don't have to
+decode the JWT and look the user up again every time.
+
+Entries expire after AUTH_CACHE_TTL_SECONDS or when the token does,
+whichever comes first, and are dropped as soon as the user they belong to
+is changed or deleted through the ORM.
+"""
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from db_models import User
+from sqlalchemy import event
+from utils import metrics
+from utils.ttl_cache import TTLCache
+
+# Most tokens kept at once; the least recently used go first
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "1024"))
+# Longest a token is trusted without looking at the user again
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    The parts of a user that requests need to know who is calling.
+    """
+    id: int
+    email: str
+
+
+class TokenCache(TTLCache[Principal]):
+    def __init__(self, size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL_SECONDS):
+        # Token expiry is a Unix time, so entries are timed on the same clock
+        super().__init__(size, ttl, clock=time.time)
+
+    def put(self, token: str, principal: Principal, token_expires_at: Optional[float] = None):
+        super().put(token, principal, token_expires_at)
+
+    def invalidate_user(self, user_id: int):
+        self.discard_where(lambda principal: principal.id == user_id)
+
+
+token_cache = TokenCache()
+
+
+def _lookups() -> metrics.Sample:
+    stats = token_cache.stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+metrics.Counter("auth_token_cache_lookups_total", "Access token lookups in the cache, by result", ("result",), function=_lookups)
+metrics.Counter("auth_token_cache_evictions_total", "Tokens evicted to make room", function=lambda: token_cache.stats()["evictions"])
+metrics.Gauge("auth_token_cache_entries", "Tokens in the cache", function=lambda: token_cache.stats()["size"])
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target: User):
+    token_cache.invalidate_user(target.id)
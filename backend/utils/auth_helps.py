@@ -1,18 +1,23 @@
 
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
-from db_models import Document, User, UserDocumentAssociation, get_db
+from db_models import User, get_db
 from fastapi import (
     Depends,
     HTTPException,
     WebSocket,
     status,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
+from utils.auth_cache import Principal, token_cache
 
 # Database setup
 
@@ -22,16 +27,22 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt is deliberately slow; hashing at most this many passwords at once
+# leaves the event loop a core even during a login storm
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+_password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Utility functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt takes a few hundred milliseconds; awaiting its pool holds neither
+# the event loop nor a threadpool thread, which other handlers need meanwhile
+async def verify_password(plain_password, hashed_password) -> bool:
+    return await asyncio.wrap_future(_password_pool.submit(pwd_context.verify, plain_password, hashed_password))
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password) -> str:
+    return await asyncio.wrap_future(_password_pool.submit(pwd_context.hash, password))
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -42,29 +53,43 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+def authenticate_token(token: str, db: Session) -> Optional[Principal]:
+    """
+    Resolve an access token to the user it was issued to, or None if that
+    user no longer exists. Raises JWTError for a token that doesn't verify.
+    """
+    principal = token_cache.get(token)
+    if principal is not None:
+        return principal
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email: str = payload.get("sub")
+    if email is None:
+        raise JWTError("Token has no subject")
+    user = db.query(User).filter(User.email == email).first()
+    if user is None:
+        return None
+    principal = Principal(id=user.id, email=user.email)
+    token_cache.put(token, principal, payload.get("exp"))
+    return principal
+
 # Dependency to get the current user
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        user = authenticate_token(token, db)
     except JWTError:
         raise credentials_exception
-    
-    user = db.query(User).filter(User.email == email).first()
     if user is None:
         raise credentials_exception
     return user
 async def get_current_user_ws(
     websocket: WebSocket,
     db: Session = Depends(get_db)
-) -> User:
+) -> Principal:
     try:
         # Get token from query parameter
         token = websocket.query_params.get('token')
@@ -72,15 +97,8 @@ async def get_current_user_ws(
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             raise HTTPException(status_code=401, detail="Not authenticated")
         
-        # Verify the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # Get user from database
-        user = db.query(User).filter(User.email == email).first()
+        # Verify the token and find its user
+        user = await run_in_threadpool(authenticate_token, token, db)
         if user is None:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             raise HTTPException(status_code=401, detail="User not found")
@@ -90,14 +108,3 @@ async def get_current_user_ws(
     except JWTError:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         raise HTTPException(status_code=401, detail="Invalid token")
-
-def authorized_view(user: User, document_id: int, db: Session):
-    """
-    Check if the user is the owner of the document or has the permission to view the document
-    """
-    all_authorized_documents = db.query(Document).outerjoin(
-            UserDocumentAssociation, Document.id == UserDocumentAssociation.document_id
-        ).filter(
-            (UserDocumentAssociation.user_id == user.id) | (Document.owner_id == user.id)
-        ).all()
-    return document_id in [document.id for document in all_authorized_documents]
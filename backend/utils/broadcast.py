@@ -0,0 +1,357 @@
+"""
+Pluggable pub/sub used to fan room messages out across worker processes.
+
+Every backend delivers the messages published to a room to every worker
+subscribed to it, the publishing worker included, in one order that all of
+them agree on. That shared order is what lets each worker keep its own copy
+of a document in step with the others.
+
+- "memory": a single process, messages never leave it.
+- "unix": several processes on one box. The first worker to grab a lock file
+  becomes the hub, serves a Unix-domain socket that every worker (itself
+  included) connects to, and routes each room's messages only to the workers
+  that have subscribers in it. If the hub goes away the others race to take
+  its place and reconnect.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from utils import metrics
+from utils.log import log_event
+
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")
+BROADCAST_SOCKET_PATH = os.getenv("BROADCAST_SOCKET_PATH", "/tmp/2note-broadcast.sock")
+# Bytes the hub lets pile up for a worker before dropping its connection
+BROADCAST_HUB_MAX_BUFFER = int(os.getenv("BROADCAST_HUB_MAX_BUFFER", str(64 * 1024 * 1024)))
+
+MessageHandler = Callable[[str, str], Awaitable[None]]
+ResetHandler = Callable[[], Awaitable[None]]
+
+_FRAME_HEADER = struct.Struct(">II")
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastBackend:
+    """
+    Interface every broadcast backend implements.
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.handler: Optional[MessageHandler] = None
+        self.on_reset: Optional[ResetHandler] = None
+
+    async def start(self, handler: MessageHandler, on_reset: Optional[ResetHandler] = None):
+        """
+        Begin delivering messages to `handler(room, payload)`. `on_reset` is
+        called when messages may have been lost, e.g. after a reconnect.
+        """
+        self.handler = handler
+        self.on_reset = on_reset
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, room: str) -> List[str]:
+        """
+        Start receiving a room's messages. Returns the ids of the other workers
+        that were already subscribed, in the order they joined.
+        """
+        raise NotImplementedError
+
+    async def unsubscribe(self, room: str):
+        raise NotImplementedError
+
+    async def publish(self, room: str, payload: str):
+        raise NotImplementedError
+
+    async def subscribers(self, room: str) -> List[str]:
+        """
+        Ids of all workers currently subscribed to a room.
+        """
+        raise NotImplementedError
+
+    def queue_depth(self) -> int:
+        """
+        Messages published by this worker that haven't gone out yet.
+        """
+        return 0
+
+
+class InProcessBackend(BroadcastBackend):
+    def __init__(self):
+        super().__init__()
+        self.rooms: Set[str] = set()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def start(self, handler: MessageHandler, on_reset: Optional[ResetHandler] = None):
+        await super().start(handler, on_reset)
+        # A queue belongs to the event loop that first uses it, and the app
+        # may be started again on another one (as each TestClient does)
+        self._queue = asyncio.Queue()
+        # Deliver from a task so that, as with the other backends, publishing
+        # from inside a handler never runs a nested handler
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    async def subscribe(self, room: str) -> List[str]:
+        self.rooms.add(room)
+        return []
+
+    async def unsubscribe(self, room: str):
+        self.rooms.discard(room)
+
+    async def publish(self, room: str, payload: str):
+        self._queue.put_nowait((room, payload))
+
+    async def subscribers(self, room: str) -> List[str]:
+        return [self.worker_id] if room in self.rooms else []
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def _dispatch(self):
+        while True:
+            room, payload = await self._queue.get()
+            if room in self.rooms:
+                try:
+                    await self.handler(room, payload)
+                except Exception:
+                    log_event(logger, logging.ERROR, "broadcast.handler_failed", exc_info=True, room=room)
+
+
+def _encode_frame(header: dict, payload: bytes = b"") -> bytes:
+    head = json.dumps(header, separators=(",", ":")).encode()
+    return _FRAME_HEADER.pack(len(head), len(payload)) + head + payload
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    head_length, payload_length = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(head_length))
+    payload = await reader.readexactly(payload_length) if payload_length else b""
+    return header, payload
+
+
+class _Hub:
+    """
+    Routes frames between the workers connected to the socket. Payloads are
+    forwarded as opaque bytes; only the small header is parsed.
+    """
+
+    def __init__(self):
+        self.rooms: Dict[str, Dict[asyncio.StreamWriter, str]] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, path: str):
+        if os.path.exists(path):
+            # Left behind by a hub that died; we hold the lock, so it's stale
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._serve, path=path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = ""
+        try:
+            while True:
+                header, payload = await _read_frame(reader)
+                op = header["op"]
+                room = header.get("room")
+                if op == "hello":
+                    worker_id = header["worker"]
+                elif op == "sub":
+                    members = self.rooms.setdefault(room, {})
+                    others = [member for member in members.values() if member != worker_id]
+                    members[writer] = worker_id
+                    self._send(writer, {"op": "reply", "id": header["id"], "workers": others})
+                elif op == "unsub":
+                    self._leave(room, writer)
+                elif op == "count":
+                    workers = list(self.rooms.get(room, {}).values())
+                    self._send(writer, {"op": "reply", "id": header["id"], "workers": workers})
+                elif op == "pub":
+                    frame = _encode_frame({"op": "msg", "room": room}, payload)
+                    for member in list(self.rooms.get(room, {})):
+                        self._send(member, frame)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for room in list(self.rooms):
+                self._leave(room, writer)
+            writer.close()
+
+    def _send(self, writer: asyncio.StreamWriter, frame):
+        if isinstance(frame, dict):
+            frame = _encode_frame(frame)
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > BROADCAST_HUB_MAX_BUFFER:
+            # It stopped reading; cut it loose and let it reconnect and reset
+            log_event(logger, logging.WARNING, "broadcast.hub_dropped_worker")
+            writer.close()
+            return
+        writer.write(frame)
+
+    def _leave(self, room: str, writer: asyncio.StreamWriter):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.pop(writer, None)
+            if not members:
+                del self.rooms[room]
+
+
+class UnixSocketBackend(BroadcastBackend):
+    def __init__(self, path: str = BROADCAST_SOCKET_PATH):
+        super().__init__()
+        self.path = path
+        self.rooms: Set[str] = set()
+        self._hub: Optional[_Hub] = None
+        self._lock_file = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._write_lock = asyncio.Lock()
+        self._connected = asyncio.Event()
+        self._replies: Dict[str, asyncio.Future] = {}
+        self._receiver: Optional[asyncio.Task] = None
+        # Frames waiting for the write lock or for the socket to drain
+        self._queued = 0
+
+    async def start(self, handler: MessageHandler, on_reset: Optional[ResetHandler] = None):
+        await super().start(handler, on_reset)
+        await self._connect()
+        self._receiver = asyncio.create_task(self._receive())
+
+    async def stop(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self._writer is not None:
+            self._writer.close()
+        if self._hub is not None:
+            await self._hub.stop()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    async def subscribe(self, room: str) -> List[str]:
+        self.rooms.add(room)
+        return await self._request({"op": "sub", "room": room})
+
+    async def unsubscribe(self, room: str):
+        self.rooms.discard(room)
+        await self._write({"op": "unsub", "room": room})
+
+    async def publish(self, room: str, payload: str):
+        await self._write({"op": "pub", "room": room}, payload.encode())
+
+    async def subscribers(self, room: str) -> List[str]:
+        return await self._request({"op": "count", "room": room})
+
+    def queue_depth(self) -> int:
+        return self._queued
+
+    async def _request(self, header: dict) -> List[str]:
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        try:
+            await self._write({**header, "id": request_id})
+            return await future
+        finally:
+            self._replies.pop(request_id, None)
+
+    async def _write(self, header: dict, payload: bytes = b""):
+        self._queued += 1
+        try:
+            await self._connected.wait()
+            async with self._write_lock:
+                self._writer.write(_encode_frame(header, payload))
+                await self._writer.drain()
+        finally:
+            self._queued -= 1
+
+    async def _connect(self):
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not await self._become_hub():
+                    # Somebody else is starting the hub; give it a moment
+                    await asyncio.sleep(0.1)
+        self._writer.write(_encode_frame({"op": "hello", "worker": self.worker_id}))
+        for room in self.rooms:
+            self._writer.write(_encode_frame({"op": "sub", "room": room, "id": ""}))
+        await self._writer.drain()
+        self._connected.set()
+
+    async def _become_hub(self) -> bool:
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._hub = _Hub()
+        await self._hub.start(self.path)
+        return True
+
+    async def _receive(self):
+        while True:
+            try:
+                header, payload = await _read_frame(self._reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log_event(logger, logging.WARNING, "broadcast.hub_connection_lost")
+                self._connected.clear()
+                self._writer.close()
+                for future in self._replies.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("broadcast hub went away"))
+                await self._connect()
+                if self.on_reset is not None:
+                    await self.on_reset()
+                continue
+            if header["op"] == "msg":
+                try:
+                    await self.handler(header["room"], payload.decode())
+                except Exception:
+                    log_event(logger, logging.ERROR, "broadcast.handler_failed", exc_info=True, room=header["room"])
+            elif header["op"] == "reply":
+                future = self._replies.get(header["id"])
+                if future is not None and not future.done():
+                    future.set_result(header["workers"])
+
+
+def create_backend() -> BroadcastBackend:
+    if BROADCAST_BACKEND == "memory":
+        return InProcessBackend()
+    if BROADCAST_BACKEND == "unix":
+        return UnixSocketBackend()
+    raise ValueError(f"Unknown BROADCAST_BACKEND {BROADCAST_BACKEND!r}")
+
+
+broadcast_backend = create_backend()
+
+metrics.Gauge(
+    "broadcast_queue_depth",
+    "Room messages published by this worker that the broadcast backend hasn't taken yet",
+    function=lambda: broadcast_backend.queue_depth(),
+)
@@ -0,0 +1,403 @@
+"""
+Realtime editing protocol spoken on /ws/{document_id}.
+
+On join the server sends a "snapshot" with the content and its revision;
+a client that joins with the ETag of the copy it just fetched over REST
+gets only the revision when that copy is still current.
+Clients then send "delta" messages made against the last revision they
+know; the server rebases and applies them, answers the sender with an
+"ack" carrying the new revision and relays the delta as applied to
+everyone else. A client that falls behind sends "sync" with its revision
+and gets a "catchup" with the deltas it missed, or a fresh snapshot when
+they are no longer in the history. The server asks for that itself with a
+"resync" when it had to drop updates queued for a client that can't keep
+up; its own deltas then come back in the catchup marked as acks. Edits from
+clients that may only read the document are answered with an "error" and a
+snapshot. Who else is in the room travels in "presence" messages, see
+utils/presence.py. When the document is deleted its clients are
+disconnected with close code 4404.
+
+Edits are not applied where they are received. They are published as room
+events on the broadcast backend, and every worker with clients in the room
+applies them in the order the backend delivers them. Each worker thus holds
+an identical copy of the document with the same revisions. A worker joining
+a room that others already hold asks one of them for its copy; the first
+worker in a room loads it from the database.
+"""
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from anyio import from_thread
+from db_models import Document
+from sqlalchemy.orm import Session
+from utils import delta, metrics
+from utils.broadcast import broadcast_backend
+from utils.connection_manager import Peer, manager
+from utils.document_store import (
+    DocumentState,
+    document_store,
+    dump_state,
+    restore_state,
+    save_document,
+)
+from utils.permissions import ConnectionPermissions
+from utils.presence import presence
+
+# How long a worker joining a room waits for another one to hand its copy over
+ROOM_JOIN_TIMEOUT_SECONDS = float(os.getenv("ROOM_JOIN_TIMEOUT_SECONDS", "2"))
+ROOM_JOIN_ATTEMPTS = 3
+
+# Close code sent to clients when the broadcast backend lost messages (RFC 6455 "Service Restart")
+WS_1012_SERVICE_RESTART = 1012
+# Close code sent to clients of a document that was deleted
+WS_4404_DOCUMENT_DELETED = 4404
+
+# Messages that change the document and need write access
+EDIT_MESSAGES = ("delta", "title", "update")
+
+MESSAGES_RECEIVED = metrics.Counter("websocket_messages_received_total", "Messages from websocket clients, by type", ("type",))
+
+
+class _PendingRoom:
+    """
+    A room this worker is still getting a copy of. Events that arrive in the
+    meantime are kept and replayed on top of that copy once it is installed.
+    """
+
+    def __init__(self):
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.nonce: Optional[str] = None
+        # Loading from the database: everything after subscribing is new to us
+        self.from_db = False
+        # Our join came back: events from here on are not in the copy we'll get
+        self.joined = False
+        self.handover: Optional[asyncio.Future] = None
+        self.buffer: List[dict] = []
+
+
+_pending: Dict[int, _PendingRoom] = {}
+
+
+def snapshot_message(state: DocumentState, current: bool = False) -> dict:
+    """
+    The document at its current revision. When the client already holds
+    this exact copy (`current`), only the revision is sent.
+    """
+    message = {
+        "type": "snapshot",
+        "documentId": str(state.document_id),
+        "rev": state.rev,
+    }
+    if not current:
+        message["content"] = state.content
+        message["title"] = state.title
+    return message
+
+
+async def join_snapshot(state: DocumentState, etag: Optional[str]) -> dict:
+    """
+    snapshot_message() for a client joining with the ETag of the copy it
+    fetched, if any.
+    """
+    if etag is not None:
+        version, current = await document_store.etag(state)
+        # An edit while the ETag was worked out makes that copy stale
+        if etag == current and version == state.version:
+            return snapshot_message(state, current=True)
+    return snapshot_message(state)
+
+
+def delta_message(state: DocumentState, rev: int, ops: List[delta.Op]) -> dict:
+    return {
+        "type": "delta",
+        "documentId": str(state.document_id),
+        "rev": rev,
+        "ops": ops,
+    }
+
+
+def title_message(state: DocumentState) -> dict:
+    return {
+        "type": "title",
+        "documentId": str(state.document_id),
+        "title": state.title,
+    }
+
+
+async def join(document_id: int) -> Optional[DocumentState]:
+    """
+    Get this worker's copy of a document for one more local client, setting
+    it up if needed. Returns None if the document does not exist.
+    """
+    state = document_store.peek(document_id)
+    if state is None:
+        pending = _pending.get(document_id)
+        if pending is not None:
+            state = await asyncio.shield(pending.ready)
+        else:
+            state = await _load_room(document_id)
+    if state is None or document_store.peek(document_id) is not state:
+        # Deleted while we were getting our copy
+        return None
+    state.subscribers += 1
+    return state
+
+
+async def leave(state: DocumentState):
+    if await document_store.release(state):
+        await broadcast_backend.unsubscribe(str(state.document_id))
+
+
+async def handle_message(peer: Peer, state: DocumentState, message: dict, access: ConnectionPermissions):
+    websocket = peer.websocket
+    room = peer.document_id
+    kind = message.get("type")
+    # Only known types become label values, whatever clients send
+    MESSAGES_RECEIVED.inc(kind if kind in EDIT_MESSAGES or kind in ("sync", "presence") else "other")
+    if kind in EDIT_MESSAGES and not await access.allows("write"):
+        await _reject(peer, state, "You don't have permission to edit this document")
+        return
+    if kind == "delta":
+        base_rev = message.get("rev")
+        try:
+            if not isinstance(base_rev, int):
+                raise delta.DeltaError("rev must be an integer")
+            ops = delta.validate(message.get("ops"))
+        except delta.DeltaError as e:
+            await _reject(peer, state, str(e))
+            return
+        await _publish(state.document_id, {"kind": "delta", "origin": peer.id, "base": base_rev, "ops": ops})
+    elif kind == "sync":
+        manager.resynced(websocket, room)
+        rev = message.get("rev")
+        missing = document_store.deltas_since(state, rev) if isinstance(rev, int) else None
+        if missing is None:
+            await manager.send(websocket, room, snapshot_message(state))
+            return
+        await manager.send(websocket, room, {
+            "type": "catchup",
+            "documentId": str(state.document_id),
+            "rev": state.rev,
+            "title": state.title,
+            "deltas": [
+                {"rev": missed_rev, "ack": True} if origin == peer.id else {"rev": missed_rev, "ops": ops}
+                for missed_rev, ops, origin in missing
+            ],
+        })
+    elif kind == "title":
+        title = message.get("title")
+        if isinstance(title, str):
+            await _publish(state.document_id, {"kind": "title", "origin": peer.id, "title": title})
+    elif kind == "presence":
+        presence.update(peer, message.get("cursor"))
+    elif kind == "update":
+        content = message.get("content")
+        title = message.get("title")
+        if not isinstance(content, str) or not (title is None or isinstance(title, str)):
+            await _reject(peer, state, "content and title must be strings")
+            return
+        # Full-content updates from older clients are turned into deltas
+        await _publish(state.document_id, {"kind": "update", "origin": peer.id, "content": content, "title": title})
+
+
+async def publish_update(document_id: int, content: str, title: Optional[str] = None) -> bool:
+    """
+    Replace the content of a document that is open somewhere, so the change
+    reaches its editors and isn't overwritten by their next save. Returns
+    False when nobody has it open and the caller should write it directly.
+    """
+    room = str(document_id)
+    if (
+        document_store.peek(document_id) is None
+        and document_id not in _pending
+        and not await broadcast_backend.subscribers(room)
+    ):
+        return False
+    await _publish(document_id, {"kind": "update", "origin": None, "content": content, "title": title})
+    return True
+
+
+def replace_content(db: Session, document: Document, content: str, title: Optional[str] = None):
+    """
+    Replace a document's content from outside the editor: through the live
+    copies when it is open, straight to the database otherwise. Called from
+    REST handlers, in the threadpool.
+    """
+    if from_thread.run(publish_update, document.id, content, title):
+        return
+    save_document(db, document.id, content, title or document.title, datetime.utcnow())
+    db.commit()
+
+
+async def publish_deleted(document_id: int):
+    await _publish(document_id, {"kind": "deleted"})
+
+
+async def on_room_message(room: str, payload: str):
+    """
+    Handler for everything the broadcast backend delivers.
+    """
+    document_id = int(room)
+    event = json.loads(payload)
+    if event["kind"] == "presence":
+        # Not part of the document, so no need to wait for our copy of it
+        presence.receive(room, event)
+        return
+    pending = _pending.get(document_id)
+    if pending is not None:
+        await _hold(document_id, pending, event)
+        return
+    state = document_store.peek(document_id)
+    if state is not None:
+        await _apply(state, event)
+
+
+async def on_backend_reset():
+    """
+    The backend reconnected and may have lost events, so copies held by
+    different workers can no longer be trusted to match. Save ours and make
+    the clients reconnect, which rebuilds the rooms from scratch.
+    """
+    await document_store.flush_all()
+    await manager.close_all(WS_1012_SERVICE_RESTART)
+
+
+async def _publish(document_id: int, event: dict):
+    if "at" not in event:
+        event["at"] = datetime.utcnow().isoformat()
+    await broadcast_backend.publish(str(document_id), json.dumps(event, separators=(",", ":")))
+
+
+async def _load_room(document_id: int) -> Optional[DocumentState]:
+    room = str(document_id)
+    pending = _PendingRoom()
+    _pending[document_id] = pending
+    try:
+        state = None
+        for _ in range(ROOM_JOIN_ATTEMPTS):
+            holders = await broadcast_backend.subscribe(room)
+            if not holders:
+                # Nobody has it open, so what's in the database is current
+                pending.from_db = True
+                state = await document_store.load(document_id)
+                if state is None:
+                    await broadcast_backend.unsubscribe(room)
+                else:
+                    await _install(document_id, pending, state)
+                break
+            pending.nonce = uuid.uuid4().hex
+            pending.joined = False
+            pending.buffer = []
+            pending.handover = asyncio.get_running_loop().create_future()
+            await _publish(document_id, {"kind": "join", "nonce": pending.nonce, "from": holders[0]})
+            try:
+                # Installed by _hold when the copy arrives
+                state = await asyncio.wait_for(asyncio.shield(pending.handover), ROOM_JOIN_TIMEOUT_SECONDS)
+                break
+            except asyncio.TimeoutError:
+                # It may have just left; ask again whoever is there now
+                continue
+        else:
+            await broadcast_backend.unsubscribe(room)
+            raise RuntimeError(f"No worker handed over document {document_id}")
+        pending.ready.set_result(state)
+        return state
+    except asyncio.CancelledError:
+        pending.ready.cancel()
+        raise
+    except Exception as e:
+        if not pending.ready.done():
+            pending.ready.set_exception(e)
+            # Nobody else may be waiting; don't leave the exception unretrieved
+            pending.ready.exception()
+        raise
+    finally:
+        if _pending.get(document_id) is pending:
+            del _pending[document_id]
+
+
+async def _hold(document_id: int, pending: _PendingRoom, event: dict):
+    kind = event["kind"]
+    if pending.from_db:
+        pending.buffer.append(event)
+    elif kind == "join" and event["nonce"] == pending.nonce:
+        pending.joined = True
+    elif kind == "state" and event["nonce"] == pending.nonce:
+        if not pending.handover.done():
+            state = restore_state(document_id, event["state"])
+            await _install(document_id, pending, state)
+            pending.handover.set_result(state)
+    elif pending.joined:
+        pending.buffer.append(event)
+
+
+async def _install(document_id: int, pending: _PendingRoom, state: DocumentState):
+    document_store.install(state)
+    # Events may keep arriving while we replay; they land in the same buffer
+    while pending.buffer:
+        await _apply(state, pending.buffer.pop(0))
+    del _pending[document_id]
+
+
+async def _apply(state: DocumentState, event: dict):
+    kind = event["kind"]
+    origin = event.get("origin")
+    at = datetime.fromisoformat(event["at"])
+    if kind == "delta":
+        try:
+            rev, ops = document_store.apply_delta(state, event["base"], event["ops"], origin=origin, at=at)
+        except delta.DeltaError as e:
+            # Every worker fails the same way; only the sender's needs to answer
+            peer = manager.find(origin)
+            if peer is not None:
+                await _reject(peer, state, str(e))
+            return
+        await _fan_out(state, rev, ops, origin)
+    elif kind == "update":
+        title = event.get("title")
+        rev, ops = document_store.apply_update(state, event["content"], title, origin=origin, at=at)
+        await _fan_out(state, rev, ops, origin, title=title)
+    elif kind == "title":
+        document_store.set_title(state, event["title"], at)
+        await _fan_out(state, state.rev, [], origin, title=event["title"], ack=False)
+    elif kind == "deleted":
+        # Every worker drops the room; its clients' edits would go nowhere.
+        # The store no longer holds the copy, so leave() won't unsubscribe
+        room = str(state.document_id)
+        document_store.discard(state.document_id)
+        await broadcast_backend.unsubscribe(room)
+        await manager.close_room(room, WS_4404_DOCUMENT_DELETED)
+    elif kind == "join" and event["from"] == broadcast_backend.worker_id:
+        await _publish(state.document_id, {"kind": "state", "nonce": event["nonce"], "state": dump_state(state)})
+
+
+async def _fan_out(
+    state: DocumentState,
+    rev: int,
+    ops: List[delta.Op],
+    origin: Optional[str],
+    title: Optional[str] = None,
+    ack: bool = True,
+):
+    room = str(state.document_id)
+    peer = manager.find(origin) if origin else None
+    exclude = None
+    if peer is not None:
+        exclude = peer.websocket
+        if ack:
+            # Dropped while resyncing, the catchup carries it instead
+            await manager.send(peer.websocket, room, {"type": "ack", "rev": rev}, droppable=True)
+    if ops:
+        await manager.broadcast(delta_message(state, rev, ops), room, exclude=exclude)
+    if title is not None:
+        await manager.broadcast(title_message(state), room, exclude=exclude)
+
+
+async def _reject(peer: Peer, state: DocumentState, detail: str):
+    # The edit can't be applied; make the client start over from our copy
+    await manager.send(peer.websocket, peer.document_id, {"type": "error", "detail": detail})
+    await manager.send(peer.websocket, peer.document_id, snapshot_message(state))
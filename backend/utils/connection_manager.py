@@ -1,34 +1,202 @@
-from typing import Dict, Optional, Set
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
 
 from fastapi import WebSocket
+from utils import metrics
+from utils.log import log_event
+
+# Frames a peer may have waiting before its pending updates are dropped
+WS_SEND_QUEUE_HIGH_WATER = int(os.getenv("WS_SEND_QUEUE_HIGH_WATER", "256"))
+# A peer that has to be resynced this often within WS_RESYNC_WINDOW_SECONDS is disconnected
+WS_MAX_RESYNCS = int(os.getenv("WS_MAX_RESYNCS", "3"))
+WS_RESYNC_WINDOW_SECONDS = float(os.getenv("WS_RESYNC_WINDOW_SECONDS", "60"))
+# Longest a single frame may take to go out before the peer is considered dead
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+
+# Close code for peers that can't keep up (RFC 6455 "Try Again Later")
+WS_1013_TRY_AGAIN_LATER = 1013
+
+RESYNC_FRAME = json.dumps({"type": "resync"})
+
+logger = logging.getLogger(__name__)
+
+FRAMES_SENT = metrics.Counter("websocket_frames_sent_total", "Frames sent to websocket clients")
+FRAMES_DROPPED = metrics.Counter(
+    "websocket_frames_dropped_total", "Room updates dropped for clients that fell behind; they resync instead"
+)
+SLOW_DISCONNECTS = metrics.Counter(
+    "websocket_slow_disconnects_total", "Clients disconnected for not keeping up, by reason", ("reason",)
+)
+
+# Peer ids are unique across worker processes so they can travel in room events
+_process_tag = uuid.uuid4().hex[:8]
+_peer_ids = itertools.count(1)
+
+
+def encode(message: dict) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+class Peer:
+    """
+    One websocket in a room with its own outbound queue, drained by a writer
+    task so that a slow socket only ever delays itself.
+    """
+
+    def __init__(self, websocket: WebSocket, document_id: str):
+        self.id = f"{_process_tag}-{next(_peer_ids)}"
+        self.websocket = websocket
+        self.document_id = document_id
+        # (frame, droppable) pairs; droppable frames are room updates the
+        # peer can get back by syncing, the rest are replies meant for it
+        self.queue: Deque[Tuple[str, bool]] = deque()
+        self.ready = asyncio.Event()
+        self.resyncing = False
+        self.resync_times: Deque[float] = deque()
+        self.writer: Optional[asyncio.Task] = None
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.active_connections: Dict[str, Dict[WebSocket, Peer]] = {}
+        self.peers: Dict[str, Peer] = {}
 
-    async def connect(self, websocket: WebSocket, document_id: str):
+    async def connect(self, websocket: WebSocket, document_id: str) -> Peer:
         await websocket.accept()
         if document_id not in self.active_connections:
-            self.active_connections[document_id] = set()
-        self.active_connections[document_id].add(websocket)
+            self.active_connections[document_id] = {}
+        peer = Peer(websocket, document_id)
+        peer.writer = asyncio.create_task(self._write(peer))
+        self.active_connections[document_id][websocket] = peer
+        self.peers[peer.id] = peer
+        return peer
 
     async def disconnect(self, websocket: WebSocket, document_id: str):
+        self._remove(websocket, document_id)
+
+    def _remove(self, websocket: WebSocket, document_id: str):
         if document_id in self.active_connections:
-            self.active_connections[document_id].discard(websocket)
+            peer = self.active_connections[document_id].pop(websocket, None)
+            if peer is not None:
+                self.peers.pop(peer.id, None)
+                if peer.writer is not None and peer.writer is not asyncio.current_task():
+                    peer.writer.cancel()
             if not self.active_connections[document_id]:
                 del self.active_connections[document_id]
 
-    async def broadcast(self, message: dict, document_id: str, exclude: Optional[WebSocket] = None):
+    def peer(self, websocket: WebSocket, document_id: str) -> Optional[Peer]:
+        return self.active_connections.get(document_id, {}).get(websocket)
+
+    def find(self, peer_id: str) -> Optional[Peer]:
+        return self.peers.get(peer_id)
+
+    async def close_all(self, code: int):
+        for peer in list(self.peers.values()):
+            asyncio.create_task(self._close(peer, code))
+
+    async def close_room(self, document_id: str, code: int):
+        for peer in list(self.active_connections.get(document_id, {}).values()):
+            asyncio.create_task(self._close(peer, code))
+
+    async def send(self, websocket: WebSocket, document_id: str, message: dict, droppable: bool = False):
+        """
+        Queue a message for one peer, in order with the room's broadcasts.
+        """
+        peer = self.peer(websocket, document_id)
+        if peer is not None:
+            self._enqueue(peer, encode(message), droppable)
+
+    async def broadcast(
+        self, message: dict, document_id: str, exclude: Optional[WebSocket] = None, droppable: bool = True
+    ):
+        """
+        Queue a message for every peer in the room. Only droppable messages
+        are skipped for peers that are resyncing, since a sync brings back
+        edits but not other room state.
+        """
         if document_id in self.active_connections:
-            disconnected = set()
-            for connection in self.active_connections[document_id]:
+            # Encode once, every peer gets the same frame
+            frame = encode(message)
+            for connection, peer in list(self.active_connections[document_id].items()):
                 if connection != exclude:
-                    try:
-                        await connection.send_json(message)
-                    except RuntimeError:
-                        disconnected.add(connection)
-            
-            # Clean up disconnected clients
-            for conn in disconnected:
-                await self.disconnect(conn, document_id)
\ No newline at end of file
+                    self._enqueue(peer, frame, droppable)
+
+    def resynced(self, websocket: WebSocket, document_id: str):
+        """
+        The peer asked to be caught up; start delivering room updates again.
+        """
+        peer = self.peer(websocket, document_id)
+        if peer is not None:
+            peer.resyncing = False
+
+    def _enqueue(self, peer: Peer, frame: str, droppable: bool):
+        if droppable and peer.resyncing:
+            # It will get these back in one piece when it syncs
+            FRAMES_DROPPED.inc()
+            return
+        peer.queue.append((frame, droppable))
+        peer.ready.set()
+        if len(peer.queue) > WS_SEND_QUEUE_HIGH_WATER:
+            self._overflow(peer)
+
+    def _overflow(self, peer: Peer):
+        now = time.monotonic()
+        while peer.resync_times and now - peer.resync_times[0] > WS_RESYNC_WINDOW_SECONDS:
+            peer.resync_times.popleft()
+        peer.resync_times.append(now)
+        # Keep the replies, drop the room updates and ask the client to catch up
+        kept = [entry for entry in peer.queue if not entry[1]]
+        FRAMES_DROPPED.inc(amount=len(peer.queue) - len(kept))
+        if len(peer.resync_times) > WS_MAX_RESYNCS or len(kept) > WS_SEND_QUEUE_HIGH_WATER:
+            log_event(logger, logging.WARNING, "ws.slow_peer_disconnected", peer=peer.id, document_id=peer.document_id)
+            SLOW_DISCONNECTS.inc("queue_full")
+            peer.queue.clear()
+            self._remove(peer.websocket, peer.document_id)
+            asyncio.create_task(self._close(peer, WS_1013_TRY_AGAIN_LATER))
+            return
+        peer.queue = deque(kept)
+        peer.queue.append((RESYNC_FRAME, False))
+        peer.resyncing = True
+
+    async def _write(self, peer: Peer):
+        try:
+            while True:
+                if not peer.queue:
+                    peer.ready.clear()
+                    await peer.ready.wait()
+                    continue
+                frame, _ = peer.queue.popleft()
+                await asyncio.wait_for(peer.websocket.send_text(frame), WS_SEND_TIMEOUT_SECONDS)
+                FRAMES_SENT.inc()
+        except asyncio.TimeoutError:
+            log_event(logger, logging.WARNING, "ws.send_timeout", peer=peer.id, document_id=peer.document_id)
+            SLOW_DISCONNECTS.inc("send_timeout")
+            await self._close(peer, WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            # The socket is gone; the receive loop takes care of the rest
+            await self.disconnect(peer.websocket, peer.document_id)
+
+    async def _close(self, peer: Peer, code: int):
+        await self.disconnect(peer.websocket, peer.document_id)
+        try:
+            await asyncio.wait_for(peer.websocket.close(code=code), WS_SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+
+manager = ConnectionManager()
+
+metrics.Gauge("websocket_connections", "Open websocket connections", function=lambda: len(manager.peers))
+metrics.Gauge("websocket_rooms", "Documents with at least one open websocket", function=lambda: len(manager.active_connections))
+metrics.Gauge(
+    "websocket_send_queue_frames",
+    "Frames waiting to be sent, over all connections",
+    function=lambda: sum(len(peer.queue) for peer in manager.peers.values()),
+)
@@ -0,0 +1,338 @@
+"""
+Document content stored as compressed, content-addressed chunks.
+
+Saving a document first takes its large inline images (Quill embeds them as
+base64 data URIs) out into content_blobs, leaving a short reference in the
+text. What remains is cut into chunks at block boundaries chosen by the
+content around them, so an edit changes the chunks it touches and leaves
+the cuts elsewhere where they were. Chunks are zlib compressed and keyed by
+their hash. A document holds the list of its chunk hashes, its manifest.
+Saving writes only the chunks nobody has stored yet. An image, or a run of
+text, that several documents or versions share is stored once.
+
+Reading joins the chunks and puts the images back, so clients always see
+the content exactly as it was saved. Documents saved before chunked
+storage keep their content in documents.content until their next save.
+
+Chunks and blobs nothing refers to any more are left behind by saves and
+deletes; `python manage.py collect-content-garbage` removes them.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from db_models import ContentBlob, ContentChunk, Document, SessionLocal
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from utils.revisions import iter_revision_contents
+
+# Chunks are cut at block boundaries once they are at least this many
+# characters long...
+CONTENT_CHUNK_MIN_CHARS = int(os.getenv("CONTENT_CHUNK_MIN_CHARS", "4096"))
+# ...and wherever they have to be to stay under this
+CONTENT_CHUNK_MAX_CHARS = int(os.getenv("CONTENT_CHUNK_MAX_CHARS", "65536"))
+# Inline images with at least this many base64 characters are stored as blobs
+CONTENT_BLOB_MIN_CHARS = int(os.getenv("CONTENT_BLOB_MIN_CHARS", "4096"))
+# Garbage younger than this is kept, for saves and reads still using it
+CONTENT_GC_GRACE_SECONDS = float(os.getenv("CONTENT_GC_GRACE_SECONDS", "3600"))
+
+# Past CONTENT_CHUNK_MIN_CHARS, about one block boundary in this many is a cut
+_CUT_ONE_IN = 8
+# Characters before a boundary that decide whether it is a cut
+_CUT_WINDOW = 64
+# Chunks fetched per query when streaming
+CHUNKS_PER_READ = 16
+
+_BOUNDARY = re.compile(r"</(?:p|div|h[1-6]|li|ol|ul|blockquote|pre)>|<br\s*/?>|\n", re.IGNORECASE)
+_DATA_URI = re.compile(r"data:(image/[A-Za-z0-9.+-]+);base64,([A-Za-z0-9+/]+={0,2})")
+# Private use characters around a blob hash stand in for the data URI
+_REF_START = "\ue002"
+_REF_END = "\ue003"
+_REF = re.compile(_REF_START + r"([0-9a-f]{32})" + _REF_END)
+
+
+@dataclass
+class PreparedContent:
+    """
+    Content split for storage; see prepare().
+    """
+    # The content with blob references in place of the images
+    stored: str
+    chunks: List[Tuple[str, str]]
+    # Blob hash -> (mime type, bytes)
+    blobs: Dict[str, Tuple[str, bytes]]
+
+    @property
+    def manifest(self) -> List[str]:
+        return [chunk_hash for chunk_hash, _ in self.chunks]
+
+
+def prepare(content: str) -> PreparedContent:
+    """
+    Everything about storing `content` that doesn't need the database.
+    """
+    blobs: Dict[str, Tuple[str, bytes]] = {}
+
+    def extract(match: re.Match) -> str:
+        encoded = match.group(2)
+        if len(encoded) < CONTENT_BLOB_MIN_CHARS:
+            return match.group(0)
+        data = base64.b64decode(encoded)
+        # Only what comes back byte for byte, or reads would change the content
+        if base64.b64encode(data).decode() != encoded:
+            return match.group(0)
+        mime = match.group(1)
+        blob_hash = _hash(mime.encode() + b"\0" + data)
+        blobs[blob_hash] = (mime, data)
+        return _REF_START + blob_hash + _REF_END
+
+    stored = _DATA_URI.sub(extract, content or "")
+    return PreparedContent(
+        stored=stored,
+        chunks=[(_hash(piece.encode()), piece) for piece in split(stored)],
+        blobs=blobs,
+    )
+
+
+def split(stored: str) -> List[str]:
+    """
+    Cut text into chunks. Whether a block boundary is a cut depends only on
+    the text just before it, so an edit moves no cuts beyond the next one.
+    """
+    pieces = []
+    start = 0
+    for match in _BOUNDARY.finditer(stored):
+        end = match.end()
+        while end - start > CONTENT_CHUNK_MAX_CHARS:
+            start = _cut_hard(stored, start, pieces)
+        if end - start >= CONTENT_CHUNK_MIN_CHARS and _is_cut(stored[max(start, end - _CUT_WINDOW):end]):
+            pieces.append(stored[start:end])
+            start = end
+    while len(stored) - start > CONTENT_CHUNK_MAX_CHARS:
+        start = _cut_hard(stored, start, pieces)
+    if start < len(stored):
+        pieces.append(stored[start:])
+    return pieces
+
+
+def manifest_etag(title: str, last_modified: datetime, manifest: List[str]) -> str:
+    """
+    Version token for a document as GET /documents/{id} returns it; equal
+    tokens mean identical responses. The manifest stands in for the
+    content, so stored documents get one without reading their chunks.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([title or "", last_modified.isoformat(), manifest]).encode())
+    return digest.hexdigest()
+
+
+def content_etag(title: str, content: str, last_modified: datetime) -> str:
+    """
+    manifest_etag() for content in memory, e.g. a document open for editing.
+    """
+    return manifest_etag(title, last_modified, prepare(content).manifest)
+
+
+def store(db: Session, prepared: PreparedContent, previous: Optional[List[str]] = None):
+    """
+    Write the chunks and blobs of `prepared` that aren't stored yet. Chunks
+    in `previous`, the manifest it replaces, are known to be there.
+    """
+    known = set(previous or ())
+    new = {chunk_hash: piece for chunk_hash, piece in prepared.chunks if chunk_hash not in known}
+    if not new:
+        return
+    now = datetime.utcnow()
+    _store_chunks(db, new, now)
+    # Only new chunks can hold a reference the document didn't have before
+    referenced = {blob_hash for piece in new.values() for blob_hash in _REF.findall(piece)}
+    blobs = {blob_hash: prepared.blobs[blob_hash] for blob_hash in referenced if blob_hash in prepared.blobs}
+    if blobs:
+        _store_blobs(db, blobs, now)
+
+
+def dump_manifest(manifest: List[str]) -> str:
+    return json.dumps(manifest, separators=(",", ":"))
+
+
+def load_manifest(manifest: Optional[str]) -> Optional[List[str]]:
+    return json.loads(manifest) if manifest is not None else None
+
+
+def read_stored(db: Session, manifest: Optional[List[str]], legacy: Optional[str]) -> str:
+    """
+    A document's content as stored, blob references included. `legacy` is
+    documents.content, used by documents that have no manifest yet.
+    """
+    if manifest is None:
+        return prepare(legacy).stored
+    return "".join(_read_chunks(db, manifest))
+
+
+def read_replaced(db: Session, previous: List[str], prepared: PreparedContent) -> str:
+    """
+    The stored content that `prepared` replaces, reading only the chunks
+    the two don't share; after a small edit, that is one or two.
+    """
+    pieces = dict(prepared.chunks)
+    missing = [chunk_hash for chunk_hash in previous if chunk_hash not in pieces]
+    pieces.update(zip(missing, _read_chunks(db, missing)))
+    return "".join(pieces[chunk_hash] for chunk_hash in previous)
+
+
+def read(db: Session, manifest: Optional[List[str]], legacy: Optional[str]) -> str:
+    """
+    A document's content as it was saved.
+    """
+    if manifest is None:
+        return legacy or ""
+    return inline(db, "".join(_read_chunks(db, manifest)))
+
+
+def stream(manifest: List[str]) -> Iterator[str]:
+    """
+    A stored document's content, a few chunks at a time. Opens its own
+    session, since a response streams after the request's is closed.
+    """
+    db = SessionLocal()
+    try:
+        carry = ""
+        for start in range(0, len(manifest), CHUNKS_PER_READ):
+            stored = carry + "".join(_read_chunks(db, manifest[start:start + CHUNKS_PER_READ]))
+            # A blob reference cut across chunks, as older saves could do,
+            # goes out whole with the next ones
+            open_ref = stored.rfind(_REF_START)
+            if open_ref != -1 and stored.find(_REF_END, open_ref) == -1:
+                stored, carry = stored[:open_ref], stored[open_ref:]
+            else:
+                carry = ""
+            yield inline(db, stored)
+        if carry:
+            yield carry
+    finally:
+        db.close()
+
+
+def inline(db: Session, stored: str) -> str:
+    """
+    Put the images back in place of their blob references.
+    """
+    hashes = set(_REF.findall(stored))
+    if not hashes:
+        return stored
+    uris = {
+        row.hash: f"data:{row.mime};base64,{base64.b64encode(row.data).decode()}"
+        for row in db.execute(
+            select(ContentBlob.hash, ContentBlob.mime, ContentBlob.data).where(ContentBlob.hash.in_(hashes))
+        )
+    }
+    return _REF.sub(lambda match: uris.get(match.group(1), match.group(0)), stored)
+
+
+def collect_garbage(db: Session, grace_seconds: float = CONTENT_GC_GRACE_SECONDS) -> Tuple[int, int]:
+    """
+    Delete chunks no manifest lists and blobs that neither those chunks nor
+    any revision refer to. Returns how many chunks and blobs were deleted.
+
+    What is in use is worked out from one read snapshot, then `db` deletes
+    the rest in short transactions. Only rows last used before the grace
+    period are deleted, so saves running meanwhile keep what they use.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    chunks_in_use = set()
+    blobs_in_use = set()
+    reader = SessionLocal()
+    try:
+        # One read transaction, so every query below sees the same database
+        reader.connection().exec_driver_sql("BEGIN")
+        for (manifest,) in reader.execute(
+            select(Document.content_manifest).where(Document.content_manifest.is_not(None))
+        ):
+            chunks_in_use.update(json.loads(manifest))
+        for chunk_hash, data in reader.execute(select(ContentChunk.hash, ContentChunk.data)).yield_per(100):
+            if chunk_hash in chunks_in_use:
+                blobs_in_use.update(_REF.findall(zlib.decompress(data).decode()))
+        for content in iter_revision_contents(reader):
+            blobs_in_use.update(_REF.findall(content))
+        chunk_garbage = [
+            chunk_hash
+            for chunk_hash in reader.scalars(select(ContentChunk.hash).where(ContentChunk.last_used_at < cutoff))
+            if chunk_hash not in chunks_in_use
+        ]
+        blob_garbage = [
+            blob_hash
+            for blob_hash in reader.scalars(select(ContentBlob.hash).where(ContentBlob.last_used_at < cutoff))
+            if blob_hash not in blobs_in_use
+        ]
+    finally:
+        reader.close()
+    for model, garbage in ((ContentChunk, chunk_garbage), (ContentBlob, blob_garbage)):
+        for start in range(0, len(garbage), 500):
+            db.query(model).filter(
+                model.hash.in_(garbage[start:start + 500]), model.last_used_at < cutoff
+            ).delete(synchronize_session=False)
+            db.commit()
+    return len(chunk_garbage), len(blob_garbage)
+
+
+def _store_chunks(db: Session, chunks: Dict[str, str], now: datetime):
+    existing = set(db.scalars(select(ContentChunk.hash).where(ContentChunk.hash.in_(chunks))))
+    if existing:
+        # Used again; keep them away from the garbage collector
+        db.query(ContentChunk).filter(ContentChunk.hash.in_(existing)).update(
+            {ContentChunk.last_used_at: now}, synchronize_session=False
+        )
+    for chunk_hash, piece in chunks.items():
+        if chunk_hash not in existing:
+            data = piece.encode()
+            db.add(ContentChunk(hash=chunk_hash, data=zlib.compress(data), size=len(data), last_used_at=now))
+
+
+def _store_blobs(db: Session, blobs: Dict[str, Tuple[str, bytes]], now: datetime):
+    existing = set(db.scalars(select(ContentBlob.hash).where(ContentBlob.hash.in_(blobs))))
+    if existing:
+        db.query(ContentBlob).filter(ContentBlob.hash.in_(existing)).update(
+            {ContentBlob.last_used_at: now}, synchronize_session=False
+        )
+    for blob_hash, (mime, data) in blobs.items():
+        if blob_hash not in existing:
+            # Images are compressed already
+            db.add(ContentBlob(hash=blob_hash, mime=mime, data=data, size=len(data), last_used_at=now))
+
+
+def _read_chunks(db: Session, manifest: Iterable[str]) -> List[str]:
+    manifest = list(manifest)
+    if not manifest:
+        return []
+    data = dict(db.execute(
+        select(ContentChunk.hash, ContentChunk.data).where(ContentChunk.hash.in_(set(manifest)))
+    ).all())
+    return [zlib.decompress(data[chunk_hash]).decode() for chunk_hash in manifest]
+
+
+def _cut_hard(stored: str, start: int, pieces: List[str]) -> int:
+    # No boundary for too long; end the chunk after a tag if there is one
+    end = start + CONTENT_CHUNK_MAX_CHARS
+    tag_end = stored.rfind(">", start + CONTENT_CHUNK_MIN_CHARS, end)
+    if tag_end != -1:
+        end = tag_end + 1
+    # Never inside a blob reference: store() finds them chunk by chunk
+    open_ref = stored.rfind(_REF_START, start, end)
+    if open_ref > start and stored.find(_REF_END, open_ref, end) == -1:
+        end = open_ref
+    pieces.append(stored[start:end])
+    return end
+
+
+def _is_cut(window: str) -> bool:
+    return zlib.crc32(window.encode()) % _CUT_ONE_IN == 0
+
+
+def _hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
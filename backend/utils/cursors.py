@@ -0,0 +1,25 @@
+"""
+Opaque cursors for keyset pagination: the sort key of the last row of a
+page, as URL-safe base64 of a JSON list.
+"""
+import base64
+import json
+from typing import Any, Callable, Tuple
+
+
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor: str, *types: Callable[[Any], Any]) -> Tuple[Any, ...]:
+    """
+    The values encode_cursor() was given, each passed through the matching
+    entry of `types`. Raises ValueError for anything it didn't hand out.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError
+        return tuple(convert(value) for convert, value in zip(types, values))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
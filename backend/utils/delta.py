@@ -0,0 +1,201 @@
+"""
+Quill-delta-style operations over a document's content string.
+
+A delta is a list of ops, each one of {"retain": n}, {"insert": "text"} or
+{"delete": n}, walked left to right over the document. Counts are in Unicode
+code points and anything after the last op is implicitly retained, so the
+size of a delta depends on the edit, not on the document.
+"""
+from typing import Dict, List, Union
+
+Op = Dict[str, Union[int, str]]
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def validate(ops) -> List[Op]:
+    """
+    Check a client supplied delta and return it normalized: adjacent ops of
+    the same kind merged, empty ops and the trailing retain dropped.
+    """
+    if not isinstance(ops, list):
+        raise DeltaError("ops must be a list")
+    normalized: List[Op] = []
+    for op in ops:
+        if not isinstance(op, dict) or len(op) != 1:
+            raise DeltaError("each op must have exactly one of retain, insert or delete")
+        (kind, value), = op.items()
+        if kind == "insert":
+            if not isinstance(value, str):
+                raise DeltaError("insert must be a string")
+        elif kind in ("retain", "delete"):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise DeltaError(f"{kind} must be a non-negative integer")
+        else:
+            raise DeltaError(f"unknown op {kind!r}")
+        _push(normalized, kind, value)
+    return _chop(normalized)
+
+
+def apply(text: str, ops: List[Op]) -> str:
+    parts = []
+    index = 0
+    for op in ops:
+        if "retain" in op:
+            end = index + op["retain"]
+            if end > len(text):
+                raise DeltaError("retain past the end of the document")
+            parts.append(text[index:end])
+            index = end
+        elif "delete" in op:
+            index += op["delete"]
+            if index > len(text):
+                raise DeltaError("delete past the end of the document")
+        else:
+            parts.append(op["insert"])
+    parts.append(text[index:])
+    return "".join(parts)
+
+
+def transform(ops: List[Op], against: List[Op], against_first: bool = True) -> List[Op]:
+    """
+    Rewrite `ops` so it applies after `against`, both having been made on the
+    same document. `against_first` breaks ties between inserts at the same
+    position: the server passes True since whatever it sequenced already wins.
+    """
+    result: List[Op] = []
+    mine = _Cursor(ops)
+    theirs = _Cursor(against)
+    while mine.has_next() or theirs.has_next():
+        if theirs.peek_kind() == "insert" and (against_first or mine.peek_kind() != "insert"):
+            _push(result, "retain", len(theirs.take()["insert"]))
+        elif mine.peek_kind() == "insert":
+            _push(result, "insert", mine.take()["insert"])
+        else:
+            length = min(mine.peek_length(), theirs.peek_length())
+            my_op = mine.take(length)
+            their_op = theirs.take(length)
+            if "delete" in their_op:
+                # Already gone, whatever we meant to do with it
+                continue
+            if "delete" in my_op:
+                _push(result, "delete", length)
+            else:
+                _push(result, "retain", length)
+    return _chop(result)
+
+
+def diff(old: str, new: str) -> List[Op]:
+    """
+    Cheap single-region diff: keep the common prefix and suffix and replace
+    what is between. Used to turn full-content updates into deltas.
+    """
+    prefix = _common_prefix_length(old, new)
+    limit = min(len(old), len(new)) - prefix
+    suffix = _common_suffix_length(old, new, limit)
+    ops: List[Op] = []
+    _push(ops, "retain", prefix)
+    _push(ops, "delete", len(old) - prefix - suffix)
+    _push(ops, "insert", new[prefix:len(new) - suffix])
+    return _chop(ops)
+
+
+def edit_size(ops: List[Op]) -> int:
+    size = 0
+    for op in ops:
+        if "insert" in op:
+            size += len(op["insert"])
+        elif "delete" in op:
+            size += op["delete"]
+    return size
+
+
+def _push(ops: List[Op], kind: str, value: Union[int, str]):
+    if not value:
+        return
+    if ops and kind in ops[-1]:
+        ops[-1] = {kind: ops[-1][kind] + value}
+    elif kind == "insert" and ops and "delete" in ops[-1]:
+        # Keep inserts before deletes at the same position so equal edits compare equal
+        deleted = ops.pop()
+        _push(ops, "insert", value)
+        ops.append(deleted)
+    else:
+        ops.append({kind: value})
+
+
+def _chop(ops: List[Op]) -> List[Op]:
+    if ops and "retain" in ops[-1]:
+        ops.pop()
+    return ops
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    # Bisect with slice comparisons so the scan runs at C speed
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[low:mid] == b[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _common_suffix_length(a: str, b: str, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid:len(a) - low] == b[len(b) - mid:len(b) - low]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class _Cursor:
+    """
+    Walks a delta op by op, splitting retains and deletes on demand.
+    """
+
+    def __init__(self, ops: List[Op]):
+        self.ops = ops
+        self.index = 0
+        self.offset = 0
+
+    def has_next(self) -> bool:
+        return self.index < len(self.ops)
+
+    def peek_kind(self) -> str:
+        if not self.has_next():
+            # Past the end everything is an implicit retain
+            return "retain"
+        return next(iter(self.ops[self.index]))
+
+    def peek_length(self) -> float:
+        if not self.has_next():
+            return float("inf")
+        op = self.ops[self.index]
+        if "insert" in op:
+            return len(op["insert"]) - self.offset
+        return next(iter(op.values())) - self.offset
+
+    def take(self, length: float = float("inf")) -> Op:
+        if not self.has_next():
+            return {"retain": length}
+        op = self.ops[self.index]
+        kind = next(iter(op))
+        remaining = self.peek_length()
+        if length >= remaining:
+            length = remaining
+            start = self.offset
+            self.index += 1
+            self.offset = 0
+        else:
+            start = self.offset
+            self.offset += length
+        if kind == "insert":
+            return {"insert": op["insert"][start:start + length]}
+        return {kind: length}
@@ -0,0 +1,398 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from db_models import Document, SessionLocal, UserDocumentAssociation, WriteSessionLocal
+from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from utils import content_store, delta, metrics
+from utils.log import log_event
+from utils.revisions import record_revision
+from utils.search import index_document
+
+# Flush a document once it has been idle (no edits) for this long
+DOCUMENT_FLUSH_INTERVAL_SECONDS = float(os.getenv("DOCUMENT_FLUSH_INTERVAL_SECONDS", "2"))
+# Flush a document as soon as this many bytes of edits are waiting to be saved
+DOCUMENT_FLUSH_DIRTY_BYTES = int(os.getenv("DOCUMENT_FLUSH_DIRTY_BYTES", str(64 * 1024)))
+# Upper bound on the edit time a crash can lose, even while someone keeps typing
+DOCUMENT_MAX_UNSAVED_SECONDS = float(os.getenv("DOCUMENT_MAX_UNSAVED_SECONDS", "10"))
+# How often the background flusher looks for documents that are due
+DOCUMENT_FLUSH_TICK_SECONDS = min(0.5, DOCUMENT_FLUSH_INTERVAL_SECONDS, DOCUMENT_MAX_UNSAVED_SECONDS)
+# Recent deltas kept per open document to rebase concurrent edits and catch clients up
+DOCUMENT_HISTORY_LENGTH = int(os.getenv("DOCUMENT_HISTORY_LENGTH", "500"))
+
+logger = logging.getLogger(__name__)
+
+FLUSHES = metrics.Counter("document_flushes_total", "Batched writes of open documents to the database, by outcome", ("outcome",))
+
+
+@dataclass
+class DocumentState:
+    """
+    Authoritative in-memory copy of a document that has open websocket rooms
+    """
+    document_id: int
+    content: str
+    title: str
+    last_modified: datetime
+    # Server assigned revision, bumped by every delta and shared with clients
+    rev: int = 0
+    # (rev, delta as applied, id of the peer that sent it)
+    history: Deque[Tuple[int, List[delta.Op], Optional[str]]] = field(
+        default_factory=lambda: deque(maxlen=DOCUMENT_HISTORY_LENGTH)
+    )
+    # Bumped on every edit, compared against saved_version to know what is unsaved
+    version: int = 0
+    saved_version: int = 0
+    dirty_bytes: int = 0
+    first_dirty_at: Optional[float] = None
+    last_edit_at: float = 0.0
+    subscribers: int = 0
+    # (version, ETag) last worked out, see DocumentStore.etag()
+    etag: Optional[Tuple[int, str]] = None
+    flush_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.saved_version
+
+
+def _load_document(document_id: int) -> Optional[DocumentState]:
+    db = SessionLocal()
+    try:
+        row = db.query(
+            Document.content, Document.content_manifest, Document.title, Document.last_modified
+        ).filter(Document.id == document_id).first()
+        if row is None:
+            return None
+        manifest = content_store.load_manifest(row.content_manifest)
+        state = DocumentState(
+            document_id=document_id,
+            content=content_store.read(db, manifest, row.content),
+            title=row.title,
+            last_modified=row.last_modified,
+        )
+        # The same ETag GET /documents/{id} gives the stored document
+        if manifest is not None:
+            etag = content_store.manifest_etag(row.title, row.last_modified, manifest)
+        else:
+            etag = content_store.content_etag(row.title, state.content, row.last_modified)
+        state.etag = (state.version, etag)
+        return state
+    finally:
+        db.close()
+
+
+def dump_state(state: DocumentState) -> dict:
+    """
+    What a worker that joins a room late needs to hold the same copy.
+    """
+    return {
+        "rev": state.rev,
+        "content": state.content,
+        "title": state.title,
+        "last_modified": state.last_modified.isoformat(),
+        "history": list(state.history),
+    }
+
+
+def restore_state(document_id: int, data: dict) -> DocumentState:
+    state = DocumentState(
+        document_id=document_id,
+        content=data["content"],
+        title=data["title"],
+        last_modified=datetime.fromisoformat(data["last_modified"]),
+        rev=data["rev"],
+    )
+    state.history.extend(tuple(entry) for entry in data["history"])
+    return state
+
+
+def save_document(db: Session, document_id: int, content: str, title: str, last_modified: datetime) -> bool:
+    """
+    Write a document's content and title along with its search index entry
+    and a revision, unless what is stored is newer. Returns whether it was
+    written; the caller commits.
+    """
+    prepared = content_store.prepare(content)
+    while True:
+        row = db.query(
+            Document.content, Document.content_manifest, Document.title, Document.last_modified
+        ).filter(Document.id == document_id).first()
+        # Every worker holding the document saves it; one that lags behind
+        # the others must not roll the row back
+        if row is None or (row.last_modified is not None and row.last_modified > last_modified):
+            return False
+        # Only overwrite what we just read, so the revision is a diff
+        # against exactly the content it replaces
+        unchanged = (
+            Document.last_modified.is_(None) if row.last_modified is None
+            else Document.last_modified == row.last_modified
+        )
+        previous = content_store.load_manifest(row.content_manifest)
+        updated = db.query(Document).filter(Document.id == document_id, unchanged).update(
+            {
+                Document.content: "",
+                Document.content_manifest: content_store.dump_manifest(prepared.manifest),
+                Document.title: title,
+                Document.last_modified: last_modified,
+            },
+            synchronize_session=False,
+        )
+        if updated:
+            break
+    # The shared documents list is ordered by this copy
+    db.query(UserDocumentAssociation).filter(UserDocumentAssociation.document_id == document_id).update(
+        {UserDocumentAssociation.last_modified: last_modified}, synchronize_session=False
+    )
+    content_store.store(db, prepared, previous)
+    if previous != prepared.manifest or row.title != title:
+        index_document(db, document_id, title, prepared.stored)
+        # Revisions hold the content as stored, with image references. One
+        # saved before chunked storage starts over from a snapshot
+        previous_stored = content_store.read_replaced(db, previous, prepared) if previous is not None else None
+        record_revision(db, document_id, previous_stored, prepared.stored, title, last_modified)
+    return True
+
+
+def _write_document(document_id: int, content: str, title: str, last_modified: datetime):
+    db = WriteSessionLocal()
+    try:
+        save_document(db, document_id, content, title, last_modified)
+        db.commit()
+    finally:
+        db.close()
+
+
+class DocumentStore:
+    """
+    Write-behind cache for documents that are being edited over websockets.
+
+    Updates are applied to the in-memory state immediately and written to the
+    database in coalesced batches: when a document goes idle, when enough edits
+    pile up, when its oldest unsaved edit reaches DOCUMENT_MAX_UNSAVED_SECONDS,
+    when the last client leaves, and on shutdown. All DB work runs in the
+    threadpool so the event loop never waits on SQLite.
+    """
+
+    def __init__(self):
+        self.documents: Dict[int, DocumentState] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        # Flushes started by edits; the loop only keeps weak references to tasks
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush_all()
+
+    def peek(self, document_id: int) -> Optional[DocumentState]:
+        return self.documents.get(document_id)
+
+    async def load(self, document_id: int) -> Optional[DocumentState]:
+        """
+        Read a document from the database, or None if it does not exist.
+        """
+        return await run_in_threadpool(_load_document, document_id)
+
+    async def etag(self, state: DocumentState) -> Tuple[int, str]:
+        """
+        The ETag of the copy in memory, as GET /documents/{id} gives it, and
+        the version it is for. Working it out splits and hashes the whole
+        content, so it is done in the threadpool and at most once per version.
+        """
+        cached = state.etag
+        if cached is not None and cached[0] == state.version:
+            return cached
+        version = state.version
+        etag = await run_in_threadpool(content_store.content_etag, state.title, state.content, state.last_modified)
+        if state.etag is None or state.etag[0] < version:
+            state.etag = (version, etag)
+        return version, etag
+
+    def install(self, state: DocumentState):
+        self.documents[state.document_id] = state
+
+    async def release(self, state: DocumentState) -> bool:
+        """
+        Drop one subscriber; the last one out flushes and evicts the document.
+        Returns whether it was evicted.
+        """
+        state.subscribers -= 1
+        if state.subscribers > 0 or self.documents.get(state.document_id) is not state:
+            return False
+        await self.flush(state)
+        # Someone may have joined again while we were writing
+        if state.subscribers <= 0 and self.documents.get(state.document_id) is state:
+            del self.documents[state.document_id]
+            return True
+        return False
+
+    def discard(self, document_id: int):
+        """
+        Forget a document without saving it, e.g. after it has been deleted.
+        """
+        state = self.documents.pop(document_id, None)
+        if state is not None:
+            state.saved_version = state.version
+
+    def apply_delta(
+        self,
+        state: DocumentState,
+        base_rev: int,
+        ops: List[delta.Op],
+        origin: Optional[str] = None,
+        at: Optional[datetime] = None,
+    ) -> Tuple[int, List[delta.Op]]:
+        """
+        Apply a client delta made against `base_rev`, rebasing it over anything
+        sequenced since. Returns the new revision and the delta as applied,
+        which is what the other clients need. Raises DeltaError if the delta is
+        malformed or too far behind to rebase.
+        """
+        concurrent = self.deltas_since(state, base_rev)
+        if concurrent is None:
+            raise delta.DeltaError(f"revision {base_rev} is not available")
+        for _, applied, _ in concurrent:
+            ops = delta.transform(ops, applied)
+        state.content = delta.apply(state.content, ops)
+        return self._record(state, ops, delta.edit_size(ops), origin, at), ops
+
+    def apply_update(
+        self,
+        state: DocumentState,
+        content: str,
+        title: Optional[str] = None,
+        origin: Optional[str] = None,
+        at: Optional[datetime] = None,
+    ) -> Tuple[int, List[delta.Op]]:
+        """
+        Replace the whole content, recorded as a delta so that clients can
+        still catch up incrementally.
+        """
+        ops = delta.diff(state.content, content)
+        state.content = content
+        if title is not None:
+            self.set_title(state, title, at)
+        if not ops:
+            return state.rev, ops
+        return self._record(state, ops, delta.edit_size(ops), origin, at), ops
+
+    def set_title(self, state: DocumentState, title: str, at: Optional[datetime] = None):
+        state.title = title
+        self._mark_dirty(state, len(title), at)
+
+    def deltas_since(
+        self, state: DocumentState, rev: int
+    ) -> Optional[List[Tuple[int, List[delta.Op], Optional[str]]]]:
+        """
+        Deltas a client at `rev` is missing, or None if they have fallen out of
+        the history and the client needs a fresh snapshot.
+        """
+        if rev == state.rev:
+            return []
+        oldest = state.history[0][0] if state.history else state.rev + 1
+        if rev > state.rev or rev < oldest - 1:
+            return None
+        return [entry for entry in state.history if entry[0] > rev]
+
+    def _record(
+        self, state: DocumentState, ops: List[delta.Op], size: int, origin: Optional[str], at: Optional[datetime]
+    ) -> int:
+        state.rev += 1
+        state.history.append((state.rev, ops, origin))
+        self._mark_dirty(state, size, at)
+        return state.rev
+
+    async def flush(self, state: DocumentState):
+        async with state.flush_lock:
+            if not state.dirty:
+                return
+            version = state.version
+            dirty_bytes = state.dirty_bytes
+            first_dirty_at = state.first_dirty_at
+            state.dirty_bytes = 0
+            state.first_dirty_at = None
+            try:
+                await run_in_threadpool(
+                    _write_document,
+                    state.document_id,
+                    state.content,
+                    state.title,
+                    state.last_modified,
+                )
+            except Exception:
+                # Keep the edits pending so the next tick retries them
+                state.dirty_bytes += dirty_bytes
+                state.first_dirty_at = first_dirty_at or time.monotonic()
+                FLUSHES.inc("failed")
+                raise
+            FLUSHES.inc("saved")
+            state.saved_version = max(state.saved_version, version)
+
+    async def flush_all(self):
+        for state in list(self.documents.values()):
+            await self.flush(state)
+
+    def _mark_dirty(self, state: DocumentState, size: int, at: Optional[datetime] = None):
+        now = time.monotonic()
+        state.version += 1
+        state.dirty_bytes += max(1, size)
+        state.last_edit_at = now
+        # Edits from the broadcast backend carry their own time so that every
+        # worker's copy ends up with the same last_modified
+        state.last_modified = max(state.last_modified, at or datetime.utcnow())
+        if state.first_dirty_at is None:
+            state.first_dirty_at = now
+        if state.dirty_bytes >= DOCUMENT_FLUSH_DIRTY_BYTES:
+            task = asyncio.create_task(self._flush_logged(state))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    def _is_due(self, state: DocumentState, now: float) -> bool:
+        if not state.dirty:
+            return False
+        return (
+            now - state.last_edit_at >= DOCUMENT_FLUSH_INTERVAL_SECONDS
+            or now - (state.first_dirty_at or now) >= DOCUMENT_MAX_UNSAVED_SECONDS
+            or state.dirty_bytes >= DOCUMENT_FLUSH_DIRTY_BYTES
+        )
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(DOCUMENT_FLUSH_TICK_SECONDS)
+            now = time.monotonic()
+            for state in list(self.documents.values()):
+                if self._is_due(state, now):
+                    await self._flush_logged(state)
+
+    async def _flush_logged(self, state: DocumentState):
+        try:
+            await self.flush(state)
+        except Exception:
+            log_event(logger, logging.ERROR, "document.flush_failed", exc_info=True, document_id=state.document_id)
+
+
+document_store = DocumentStore()
+
+metrics.Gauge("documents_open", "Documents held in memory for websocket editing", function=lambda: len(document_store.documents))
+metrics.Gauge(
+    "documents_unsaved",
+    "Open documents with edits not written to the database yet",
+    function=lambda: sum(state.dirty for state in list(document_store.documents.values())),
+)
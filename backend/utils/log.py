@@ -0,0 +1,82 @@
+"""
+Logging setup and structured log lines.
+
+A log line is an event name plus fields. With LOG_FORMAT=text it reads
+`2024-01-01 12:00:00,000 INFO main ws.connect document_id=1 user_id=2`;
+with LOG_FORMAT=json every line is a JSON object, for log shippers.
+"""
+import json
+import logging
+import os
+import random
+
+# Lowest level that is logged: DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" for people, "json" for log shippers
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+
+def configure():
+    """
+    Send the app's logs to stderr, unless whoever runs it configured
+    logging already.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+
+def log_event(
+    logger: logging.Logger,
+    level: int,
+    event: str,
+    sample: float = 1.0,
+    exc_info: bool = False,
+    **fields,
+):
+    """
+    Log `event` with `fields`. With `sample` below 1 only that fraction of
+    calls is logged, for events on hot paths. Costs next to nothing when
+    the level is disabled.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample < 1.0 and random.random() >= sample:
+        return
+    logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        message = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={_text_value(value)}" for key, value in fields.items())
+        return message
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _text_value(value) -> str:
+    text = str(value)
+    # Quote anything that would otherwise read as more than one field
+    return json.dumps(text) if not text or any(c in text for c in ' ="\n') else text
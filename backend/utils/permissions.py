@@ -0,0 +1,132 @@
+"""
+Answers "can user U do action A on document D".
+
+A user's access to a document is a single level: "owner" for the document's
+owner, otherwise the permission it was shared with, if any. Levels are
+ordered read < write < owner and an action is allowed when the user's level
+is at least as high. Looking the level up is one primary key read of the
+document plus one probe of the unique (user_id, document_id) index, no
+matter how many documents the user has.
+"""
+import os
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from db_models import Document, SessionLocal, UserDocumentAssociation
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, select
+from sqlalchemy.orm import Session
+
+# How long a websocket trusts the access it was last found to have
+PERMISSION_CACHE_TTL_SECONDS = float(os.getenv("PERMISSION_CACHE_TTL_SECONDS", "5"))
+
+_RANKS = {"read": 1, "write": 2, "owner": 3}
+
+
+def access_level(db: Session, user_id: int, document_id: int) -> Optional[str]:
+    """
+    The user's level on the document, or None if they can't see it or it
+    doesn't exist.
+    """
+    shared = (
+        select(UserDocumentAssociation.permission)
+        .where(
+            UserDocumentAssociation.user_id == user_id,
+            UserDocumentAssociation.document_id == Document.id,
+        )
+        .scalar_subquery()
+    )
+    row = db.execute(
+        select(Document.owner_id, shared).where(Document.id == document_id)
+    ).first()
+    if row is None:
+        return None
+    owner_id, permission = row
+    if owner_id == user_id:
+        return "owner"
+    return permission
+
+
+def access_levels(db: Session, user_id: int, document_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    access_level() for many documents in one query. Documents the user
+    can't see or that don't exist are left out.
+    """
+    rows = db.execute(
+        select(Document.id, Document.owner_id, UserDocumentAssociation.permission)
+        .outerjoin(
+            UserDocumentAssociation,
+            and_(
+                UserDocumentAssociation.document_id == Document.id,
+                UserDocumentAssociation.user_id == user_id,
+            ),
+        )
+        .where(Document.id.in_(set(document_ids)))
+    )
+    levels = {}
+    for document_id, owner_id, permission in rows:
+        level = "owner" if owner_id == user_id else permission
+        if level is not None:
+            levels[document_id] = level
+    return levels
+
+
+def allows(level: Optional[str], action: str) -> bool:
+    return level is not None and _RANKS.get(level, 0) >= _RANKS[action]
+
+
+def can(db: Session, user_id: int, document_id: int, action: str) -> bool:
+    return allows(access_level(db, user_id, document_id), action)
+
+
+def require(db: Session, user_id: int, document_id: int, action: str):
+    """
+    Raise a 404 unless the user may do `action` on the document. Documents
+    the user can't act on are reported as missing so they don't leak.
+    """
+    if not can(db, user_id, document_id, action):
+        raise HTTPException(status_code=404, detail="Document not found")
+
+
+def owned(db: Session, user_id: int, document_ids: Iterable[int]) -> Set[int]:
+    """
+    Those of `document_ids` the user owns. Deleting a document is for its
+    owner alone, not for users it was shared with as "owner".
+    """
+    rows = db.execute(
+        select(Document.id).where(Document.id.in_(set(document_ids)), Document.owner_id == user_id)
+    )
+    return set(rows.scalars())
+
+
+def require_owner(db: Session, user_id: int, document_id: int):
+    if not owned(db, user_id, [document_id]):
+        raise HTTPException(status_code=404, detail="Document not found")
+
+
+class ConnectionPermissions:
+    """
+    A websocket's access to its document, looked up again at most every
+    PERMISSION_CACHE_TTL_SECONDS so that checking every message is free but
+    a revoked share still takes effect.
+    """
+
+    def __init__(self, user_id: int, document_id: int, level: Optional[str]):
+        self.user_id = user_id
+        self.document_id = document_id
+        self.level = level
+        self.checked_at = time.monotonic()
+
+    async def allows(self, action: str) -> bool:
+        if time.monotonic() - self.checked_at > PERMISSION_CACHE_TTL_SECONDS:
+            self.level = await run_in_threadpool(self._lookup)
+            self.checked_at = time.monotonic()
+        return allows(self.level, action)
+
+    def _lookup(self) -> Optional[str]:
+        db = SessionLocal()
+        try:
+            return access_level(db, self.user_id, self.document_id)
+        finally:
+            db.close()
@@ -0,0 +1,221 @@
+"""
+Who is in a document and where their cursor is, on the /ws/{document_id}
+rooms.
+
+A connection joins the room's members when its websocket connects and
+leaves when it disconnects. Clients report their selection with
+{"type": "presence", "cursor": {"index": 3, "length": 0}}, or a null cursor
+when the editor loses focus, as often as they like. Only the latest state
+of each connection is kept, and every PRESENCE_TICK_SECONDS each room gets
+the changes as a single frame:
+
+    {"type": "presence", "members": [{"id", "userId", "email", "cursor"}], "left": [ids]}
+
+so presence traffic in a room is bounded by the tick, not by how fast the
+cursors move. A client that joins first gets every member, with "self"
+holding its own id.
+
+Each worker tells the others about its own connections with at most one
+room event per tick on the broadcast backend. When someone joins, and
+every PRESENCE_HEARTBEAT_SECONDS, each worker repeats all of its members,
+so a worker new to a room learns who is there. Members of a worker that
+has not been heard from for three heartbeats, e.g. because it died, are
+dropped.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from utils import metrics
+from utils.broadcast import broadcast_backend
+from utils.connection_manager import Peer, manager
+
+# How often rooms get the presence changes since the last tick
+PRESENCE_TICK_SECONDS = float(os.getenv("PRESENCE_TICK_SECONDS", "0.1"))
+# How often a worker repeats its members to the others
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", "15"))
+# Presence messages a client may send per second; the rest are ignored
+PRESENCE_MAX_MESSAGES_PER_SECOND = float(os.getenv("PRESENCE_MAX_MESSAGES_PER_SECOND", "30"))
+
+# Members of a worker not heard from for this many heartbeats are dropped
+_MISSED_HEARTBEATS = 3
+
+Member = Dict[str, object]
+
+UPDATES = metrics.Counter("presence_updates_total", "Presence messages from clients, by outcome", ("outcome",))
+
+
+class _Room:
+    def __init__(self):
+        # Everyone in the room, on any worker, by peer id
+        self.members: Dict[str, Member] = {}
+        # The worker each member is connected to
+        self.workers: Dict[str, str] = {}
+        # Peer ids connected to this worker
+        self.local: Set[str] = set()
+        # Changes to tell the other workers and to send our clients; None
+        # means the member left
+        self.unpublished: Dict[str, Optional[Member]] = {}
+        self.unsent: Dict[str, Optional[Member]] = {}
+        # Someone joined here since we last published
+        self.joined = False
+        # Repeat our members on the next tick
+        self.announce = False
+        self.announced_at = time.monotonic()
+
+
+class PresenceTracker:
+    def __init__(self):
+        self.rooms: Dict[str, _Room] = {}
+        # When each other worker was last heard from
+        self.heard: Dict[str, float] = {}
+        # Rate limit per peer: (allowance left, when it was last topped up)
+        self._allowance: Dict[str, Tuple[float, float]] = {}
+        self._ticker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            try:
+                await self._ticker
+            except asyncio.CancelledError:
+                pass
+            self._ticker = None
+
+    async def join(self, peer: Peer, user_id: int, email: str):
+        room = self.rooms.get(peer.document_id)
+        if room is None:
+            room = self.rooms[peer.document_id] = _Room()
+        member = {"id": peer.id, "userId": user_id, "email": email, "cursor": None}
+        room.members[peer.id] = member
+        room.workers[peer.id] = broadcast_backend.worker_id
+        room.local.add(peer.id)
+        room.unpublished[peer.id] = room.unsent[peer.id] = member
+        room.joined = True
+        self._allowance[peer.id] = (PRESENCE_MAX_MESSAGES_PER_SECOND, time.monotonic())
+        await manager.send(peer.websocket, peer.document_id, {
+            "type": "presence",
+            "self": peer.id,
+            "members": list(room.members.values()),
+            "left": [],
+        })
+
+    def leave(self, peer: Peer):
+        self._allowance.pop(peer.id, None)
+        room = self.rooms.get(peer.document_id)
+        if room is None or peer.id not in room.local:
+            return
+        room.local.discard(peer.id)
+        self._remove(room, peer.id)
+        room.unpublished[peer.id] = None
+
+    def update(self, peer: Peer, cursor: object):
+        """
+        Record where a client's cursor is; it goes out with the next tick.
+        """
+        room = self.rooms.get(peer.document_id)
+        member = room.members.get(peer.id) if room is not None else None
+        if member is None:
+            return
+        if not self._allow(peer.id):
+            UPDATES.inc("rate_limited")
+            return
+        if cursor is not None and not _valid_cursor(cursor):
+            UPDATES.inc("invalid")
+            return
+        UPDATES.inc("accepted")
+        member = {**member, "cursor": cursor}
+        room.members[peer.id] = room.unpublished[peer.id] = room.unsent[peer.id] = member
+
+    def receive(self, room_id: str, event: dict):
+        """
+        Merge a batch of changes published by another worker.
+        """
+        worker = event["from"]
+        if worker == broadcast_backend.worker_id:
+            return
+        self.heard[worker] = time.monotonic()
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        for peer_id, member in event["members"].items():
+            if member is None:
+                self._remove(room, peer_id)
+            else:
+                room.workers[peer_id] = worker
+                # Heartbeats repeat what clients already have
+                if room.members.get(peer_id) != member:
+                    room.members[peer_id] = room.unsent[peer_id] = member
+        if event.get("joined"):
+            room.announce = True
+
+    def _remove(self, room: _Room, peer_id: str):
+        if room.members.pop(peer_id, None) is not None:
+            room.workers.pop(peer_id, None)
+            room.unsent[peer_id] = None
+
+    def _allow(self, peer_id: str) -> bool:
+        allowance, topped_up_at = self._allowance.get(peer_id, (PRESENCE_MAX_MESSAGES_PER_SECOND, time.monotonic()))
+        now = time.monotonic()
+        allowance = min(PRESENCE_MAX_MESSAGES_PER_SECOND, allowance + (now - topped_up_at) * PRESENCE_MAX_MESSAGES_PER_SECOND)
+        allowed = allowance >= 1
+        self._allowance[peer_id] = (allowance - 1 if allowed else allowance, now)
+        return allowed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_TICK_SECONDS)
+            for room_id, room in list(self.rooms.items()):
+                await self._tick(room_id, room)
+
+    async def _tick(self, room_id: str, room: _Room):
+        now = time.monotonic()
+        if room.announce or now - room.announced_at >= PRESENCE_HEARTBEAT_SECONDS:
+            for peer_id in room.local:
+                room.unpublished[peer_id] = room.members[peer_id]
+            room.announce = False
+            room.announced_at = now
+        stale_after = PRESENCE_HEARTBEAT_SECONDS * _MISSED_HEARTBEATS
+        for peer_id, worker in list(room.workers.items()):
+            if worker != broadcast_backend.worker_id and now - self.heard.get(worker, now) > stale_after:
+                self._remove(room, peer_id)
+        if room.unpublished:
+            event = {"kind": "presence", "from": broadcast_backend.worker_id, "members": room.unpublished}
+            if room.joined:
+                event["joined"] = True
+            room.unpublished = {}
+            room.joined = False
+            await broadcast_backend.publish(room_id, json.dumps(event, separators=(",", ":")))
+        if room.unsent:
+            changes = room.unsent
+            room.unsent = {}
+            await manager.broadcast({
+                "type": "presence",
+                "members": [member for member in changes.values() if member is not None],
+                "left": [peer_id for peer_id, member in changes.items() if member is None],
+            }, room_id, droppable=False)
+        if not room.local and not room.unpublished:
+            del self.rooms[room_id]
+
+
+def _valid_cursor(cursor: object) -> bool:
+    return (
+        isinstance(cursor, dict)
+        and set(cursor) == {"index", "length"}
+        and all(isinstance(cursor[key], int) and not isinstance(cursor[key], bool) and cursor[key] >= 0 for key in cursor)
+    )
+
+
+presence = PresenceTracker()
+
+metrics.Gauge(
+    "presence_members",
+    "Members of rooms with a connection to this worker, on any worker",
+    function=lambda: sum(len(room.members) for room in presence.rooms.values()),
+)
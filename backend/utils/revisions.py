@@ -0,0 +1,201 @@
+"""
+Revision history of document content.
+
+Every save that changes a document adds a revision. Most revisions hold
+only the delta from the revision before them; every
+REVISION_SNAPSHOT_INTERVAL-th holds the full content, so rebuilding any
+revision means applying at most that many deltas to a snapshot. Both are
+stored zlib compressed, which keeps the history close to the size of the
+edits themselves.
+"""
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Tuple
+
+from db_models import DocumentRevision
+from sqlalchemy.orm import Session
+from utils import delta
+
+# A full copy of the content is stored once every this many revisions
+REVISION_SNAPSHOT_INTERVAL = int(os.getenv("REVISION_SNAPSHOT_INTERVAL", "20"))
+# Revisions newer than this are never compacted; older ones are thinned to one a day
+REVISION_KEEP_ALL_DAYS = float(os.getenv("REVISION_KEEP_ALL_DAYS", "7"))
+
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+
+def record_revision(
+    db: Session,
+    document_id: int,
+    previous: Optional[str],
+    content: str,
+    title: str,
+    created_at: datetime,
+):
+    """
+    Add a revision for a save that replaced `previous` with `content`. The
+    caller commits it together with the save.
+    """
+    last = db.query(DocumentRevision.number).filter(
+        DocumentRevision.document_id == document_id
+    ).order_by(DocumentRevision.number.desc()).first()
+    number = last.number + 1 if last is not None else 1
+    if last is None or previous is None or _deltas_since_snapshot(db, document_id) + 1 >= REVISION_SNAPSHOT_INTERVAL:
+        kind, data = SNAPSHOT, _compress(content)
+    else:
+        kind, data = DELTA, _compress(json.dumps(delta.diff(previous, content), separators=(",", ":")))
+    db.add(DocumentRevision(
+        document_id=document_id,
+        number=number,
+        kind=kind,
+        data=data,
+        title=title,
+        size=len(content),
+        created_at=created_at,
+    ))
+
+
+def list_revisions(db: Session, document_id: int, before: Optional[int], limit: int) -> List[DocumentRevision]:
+    """
+    Revisions newest first, without their data, starting below `before`.
+    """
+    query = db.query(
+        DocumentRevision.number, DocumentRevision.title, DocumentRevision.size, DocumentRevision.created_at
+    ).filter(DocumentRevision.document_id == document_id)
+    if before is not None:
+        query = query.filter(DocumentRevision.number < before)
+    return query.order_by(DocumentRevision.number.desc()).limit(limit).all()
+
+
+def get_revision(db: Session, document_id: int, number: int) -> Optional[Tuple[DocumentRevision, str]]:
+    """
+    A revision and its content, rebuilt from the nearest snapshot before it.
+    The content is as stored; utils/content_store.py puts its images back.
+    """
+    snapshot = db.query(DocumentRevision).filter(
+        DocumentRevision.document_id == document_id,
+        DocumentRevision.number <= number,
+        DocumentRevision.kind == SNAPSHOT,
+    ).order_by(DocumentRevision.number.desc()).first()
+    if snapshot is None:
+        return None
+    revisions = db.query(DocumentRevision).filter(
+        DocumentRevision.document_id == document_id,
+        DocumentRevision.number > snapshot.number,
+        DocumentRevision.number <= number,
+    ).order_by(DocumentRevision.number).all()
+    if snapshot.number != number and (not revisions or revisions[-1].number != number):
+        return None
+    content = _decompress(snapshot.data)
+    for revision in revisions:
+        content = _apply(content, revision)
+    return (revisions[-1] if revisions else snapshot), content
+
+
+def iter_revision_contents(db: Session) -> Iterator[str]:
+    """
+    The content of every revision of every document, rebuilt in order.
+    """
+    rows = db.query(DocumentRevision).order_by(DocumentRevision.document_id, DocumentRevision.number).yield_per(100)
+    document_id = None
+    content = ""
+    for revision in rows:
+        if revision.kind == SNAPSHOT:
+            content = _decompress(revision.data)
+        elif revision.document_id == document_id:
+            content = _apply(content, revision)
+        else:
+            # Compaction never leaves a delta first; skip a document that has one
+            continue
+        document_id = revision.document_id
+        yield content
+
+
+def delete_revisions(db: Session, document_ids: List[int]):
+    db.query(DocumentRevision).filter(DocumentRevision.document_id.in_(document_ids)).delete(synchronize_session=False)
+
+
+def compact_revisions(db: Session, keep_all_days: float = REVISION_KEEP_ALL_DAYS) -> Tuple[int, int]:
+    """
+    Thin revisions older than `keep_all_days` to the last one of each day.
+    Returns how many documents were compacted and how many revisions removed.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=keep_all_days)
+    document_ids = [
+        row.document_id
+        for row in db.query(DocumentRevision.document_id).filter(
+            DocumentRevision.created_at < cutoff
+        ).distinct()
+    ]
+    documents = removed = 0
+    for document_id in document_ids:
+        count = _compact_document(db, document_id, cutoff)
+        if count:
+            documents += 1
+            removed += count
+        # One document per transaction keeps the write lock short
+        db.commit()
+    return documents, removed
+
+
+def _compact_document(db: Session, document_id: int, cutoff: datetime) -> int:
+    revisions = db.query(DocumentRevision).filter(
+        DocumentRevision.document_id == document_id
+    ).order_by(DocumentRevision.number).all()
+    keep = set()
+    last_of_day = {}
+    for revision in revisions:
+        if revision.created_at >= cutoff:
+            keep.add(revision.number)
+        else:
+            last_of_day[revision.created_at.date()] = revision.number
+    keep.update(last_of_day.values())
+    if len(keep) == len(revisions):
+        return 0
+    # Rebuild every revision in order and re-encode the kept ones against
+    # the kept revision before them
+    content = ""
+    kept_content: Optional[str] = None
+    since_snapshot = 0
+    for revision in revisions:
+        content = _decompress(revision.data) if revision.kind == SNAPSHOT else _apply(content, revision)
+        if revision.number not in keep:
+            db.delete(revision)
+            continue
+        if kept_content is None or since_snapshot + 1 >= REVISION_SNAPSHOT_INTERVAL:
+            revision.kind, revision.data = SNAPSHOT, _compress(content)
+            since_snapshot = 0
+        else:
+            ops = delta.diff(kept_content, content)
+            revision.kind, revision.data = DELTA, _compress(json.dumps(ops, separators=(",", ":")))
+            since_snapshot += 1
+        kept_content = content
+    return len(revisions) - len(keep)
+
+
+def _deltas_since_snapshot(db: Session, document_id: int) -> int:
+    # Walks back from the newest revision, so at most one interval's worth
+    kinds = db.query(DocumentRevision.kind).filter(
+        DocumentRevision.document_id == document_id
+    ).order_by(DocumentRevision.number.desc()).limit(REVISION_SNAPSHOT_INTERVAL).all()
+    count = 0
+    for row in kinds:
+        if row.kind == SNAPSHOT:
+            break
+        count += 1
+    return count
+
+
+def _apply(content: str, revision: DocumentRevision) -> str:
+    return delta.apply(content, json.loads(_decompress(revision.data)))
+
+
+def _compress(text: str) -> bytes:
+    return zlib.compress(text.encode())
+
+
+def _decompress(data: bytes) -> str:
+    return zlib.decompress(data).decode()
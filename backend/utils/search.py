@@ -0,0 +1,139 @@
+"""
+Full-text search over document titles and content, backed by the
+documents_fts FTS5 table (see db_models.init_db).
+
+The index holds the title and the text of the content with the editor's
+HTML stripped, keyed by document id. The write paths keep it current by
+calling index_documents / remove_documents in the same transaction as the
+write; `python manage.py rebuild-search-index` fills it from scratch.
+"""
+import html
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+from utils import content_store
+
+# Columns of documents_fts are (title, body); a title hit outranks a body hit
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+# Words of context around the first hit in a snippet
+SNIPPET_WORDS = 16
+
+_TAG = re.compile(r"<[^>]*>")
+_BLOCK_END = re.compile(r"</(p|div|h[1-6]|li|blockquote|pre)>|<br\s*/?>", re.IGNORECASE)
+_TERM = re.compile(r"\w+")
+# Private use characters mark hits in snippets until the text is escaped
+_MARK_START = "\ue000"
+_MARK_END = "\ue001"
+
+
+def strip_tags(content: str) -> str:
+    """
+    The text of an editor document, one line per block.
+    """
+    content = _BLOCK_END.sub("\n", content or "")
+    return html.unescape(_TAG.sub("", content))
+
+
+def build_query(query: str) -> Optional[str]:
+    """
+    Turn what the user typed into an FTS5 query that matches documents
+    containing every word, the last one as a prefix since it may still be
+    being typed. Returns None if there is nothing to search for.
+    """
+    terms = _TERM.findall(query)
+    if not terms:
+        return None
+    # Quoted, so nothing the user types is taken for FTS5 syntax
+    return " ".join(f'"{term}"' for term in terms) + "*"
+
+
+def index_document(db: Session, document_id: int, title: str, content: str):
+    index_documents(db, [(document_id, title, content)])
+
+
+def index_documents(db: Session, documents: List[Tuple[int, str, str]]):
+    """
+    Index (id, title, content) of each document, replacing what was there.
+    """
+    remove_documents(db, [document_id for document_id, _, _ in documents])
+    db.execute(
+        text("INSERT INTO documents_fts (rowid, title, body) VALUES (:id, :title, :body)"),
+        [
+            {"id": document_id, "title": title or "", "body": strip_tags(content)}
+            for document_id, title, content in documents
+        ],
+    )
+
+
+def remove_documents(db: Session, document_ids: List[int]):
+    db.execute(
+        text("DELETE FROM documents_fts WHERE rowid IN :ids").bindparams(bindparam("ids", expanding=True)),
+        {"ids": document_ids},
+    )
+
+
+def rebuild_index(db: Session) -> int:
+    """
+    Reindex every document. Returns how many were indexed.
+    """
+    db.execute(text("DELETE FROM documents_fts"))
+    count = 0
+    rows = db.execute(text("SELECT id, title, content, content_manifest FROM documents")).yield_per(500)
+    for document_id, title, content, manifest in rows:
+        stored = content_store.read_stored(db, content_store.load_manifest(manifest), content)
+        db.execute(
+            text("INSERT INTO documents_fts (rowid, title, body) VALUES (:id, :title, :body)"),
+            {"id": document_id, "title": title or "", "body": strip_tags(stored)},
+        )
+        count += 1
+    # Merge the index into a single b-tree, the fastest layout to query
+    db.execute(text("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')"))
+    return count
+
+
+def search(db: Session, user_id: int, query: str, limit: int, offset: int) -> List[dict]:
+    """
+    Documents the user can see that match `query`, best match first, with a
+    snippet of HTML-escaped text in which the hits are wrapped in <mark>.
+    """
+    match = build_query(query)
+    if match is None:
+        return []
+    rows = db.execute(
+        text(
+            "SELECT documents.id, documents.title, documents.last_modified, documents.owner_id,"
+            " snippet(documents_fts, 1, :start, :end, '…', :words) AS snippet"
+            " FROM documents_fts JOIN documents ON documents.id = documents_fts.rowid"
+            " WHERE documents_fts MATCH :match"
+            " AND (documents.owner_id = :user_id OR EXISTS ("
+            "  SELECT 1 FROM user_document_association"
+            "  WHERE user_document_association.user_id = :user_id"
+            "  AND user_document_association.document_id = documents.id))"
+            " ORDER BY bm25(documents_fts, :title_weight, :body_weight)"
+            " LIMIT :limit OFFSET :offset"
+        ).columns(last_modified=DateTime),
+        {
+            "match": match,
+            "user_id": user_id,
+            "start": _MARK_START,
+            "end": _MARK_END,
+            "words": SNIPPET_WORDS,
+            "title_weight": TITLE_WEIGHT,
+            "body_weight": BODY_WEIGHT,
+            "limit": limit,
+            "offset": offset,
+        },
+    ).all()
+    return [
+        {
+            "id": row.id,
+            "title": row.title,
+            "lastModified": row.last_modified.isoformat(),
+            "owned_by_current_user": row.owner_id == user_id,
+            "snippet": html.escape(row.snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>"),
+        }
+        for row in rows
+    ]
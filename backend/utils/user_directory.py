@@ -0,0 +1,99 @@
+"""
+Finding users by the start of their email address, for the share dialog.
+
+Matching is case insensitive for ASCII, the same as SQLite's lower(), and
+is a range scan of the index on lower(email), so a page costs the same
+however many users there are. Pages are ordered by address and continue
+from the last one returned rather than by offset.
+
+The first page for a prefix is cached for a short while, since everyone
+typing an address asks for the same few prefixes. Adding, changing or
+deleting a user through the ORM clears the cache; other workers' caches
+catch up within USER_SEARCH_CACHE_TTL_SECONDS.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+from db_models import User
+from sqlalchemy import event, func, select, tuple_
+from sqlalchemy.orm import Session
+from utils import metrics
+from utils.cursors import decode_cursor, encode_cursor
+from utils.ttl_cache import TTLCache
+
+# First pages kept at once; the least recently used go first
+USER_SEARCH_CACHE_SIZE = int(os.getenv("USER_SEARCH_CACHE_SIZE", "256"))
+# Longest a cached page is used; bounds how long a new user stays unlisted in other workers
+USER_SEARCH_CACHE_TTL_SECONDS = float(os.getenv("USER_SEARCH_CACHE_TTL_SECONDS", "30"))
+
+# (users as {"id", "email"}, cursor of the next page or None)
+Page = Tuple[List[Dict[str, object]], Optional[str]]
+
+_EMAIL_KEY = func.lower(User.email)
+
+
+page_cache: TTLCache[Page] = TTLCache(USER_SEARCH_CACHE_SIZE, USER_SEARCH_CACHE_TTL_SECONDS)
+
+
+def search_users(db: Session, prefix: str, limit: int, cursor: Optional[str] = None) -> Page:
+    """
+    Users whose email starts with `prefix`, in address order, at most
+    `limit` of them. Raises ValueError for a cursor it didn't hand out.
+    """
+    prefix = _lower(prefix.strip())
+    if cursor is None:
+        page = page_cache.get((prefix, limit))
+        if page is None:
+            page = _search(db, prefix, limit, None)
+            page_cache.put((prefix, limit), page)
+        return page
+    return _search(db, prefix, limit, decode_cursor(cursor, str, int))
+
+
+def _search(db: Session, prefix: str, limit: int, after: Optional[Tuple[str, int]]) -> Page:
+    query = select(User.id, User.email, _EMAIL_KEY.label("key")).where(_EMAIL_KEY >= prefix)
+    upper = _successor(prefix)
+    if upper is not None:
+        query = query.where(_EMAIL_KEY < upper)
+    if after is not None:
+        # The range condition lets the index skip straight to the cursor;
+        # the row value one steps past addresses equal but for case
+        query = query.where(_EMAIL_KEY >= after[0], tuple_(_EMAIL_KEY, User.id) > tuple_(*after))
+    # One more than asked for tells us whether there is a next page
+    rows = db.execute(query.order_by(_EMAIL_KEY, User.id).limit(limit + 1)).all()
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1].key, rows[-1].id)
+    return [{"id": row.id, "email": row.email} for row in rows], cursor
+
+
+def _lower(text: str) -> str:
+    # SQLite's lower() leaves anything but ASCII alone
+    return "".join(c.lower() if c.isascii() else c for c in text)
+
+
+def _successor(prefix: str) -> Optional[str]:
+    # The smallest string greater than every string starting with `prefix`
+    if not prefix:
+        return None
+    last = ord(prefix[-1])
+    if last == 0x10FFFF:
+        return _successor(prefix[:-1])
+    return prefix[:-1] + chr(last + 1)
+
+
+def _lookups() -> metrics.Sample:
+    stats = page_cache.stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+metrics.Counter("user_search_cache_lookups_total", "First page user searches looked up in the cache, by result", ("result",), function=_lookups)
+metrics.Gauge("user_search_cache_entries", "User search pages in the cache", function=lambda: page_cache.stats()["size"])
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _users_changed(mapper, connection, target: User):
+    page_cache.clear()
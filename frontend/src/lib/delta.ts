@@ -0,0 +1,178 @@
+// Client side of the delta protocol in backend/utils/delta.py. Counts are in
+// Unicode code points to match Python string indexing on the server.
+
+export type Op = { retain: number } | { insert: string } | { delete: number };
+
+const isHighSurrogate = (code: number) => code >= 0xd800 && code <= 0xdbff;
+
+export function codePointLength(text: string): number {
+  let length = 0;
+  for (let i = 0; i < text.length; i++) {
+    if (!isHighSurrogate(text.charCodeAt(i))) {
+      length++;
+    }
+  }
+  return length;
+}
+
+// UTF-16 offset reached by walking `count` code points from `start`
+function advance(text: string, start: number, count: number): number {
+  let index = start;
+  for (let i = 0; i < count; i++) {
+    if (index >= text.length) {
+      throw new Error("delta runs past the end of the document");
+    }
+    index += isHighSurrogate(text.charCodeAt(index)) ? 2 : 1;
+  }
+  return index;
+}
+
+function push(ops: Op[], op: Op) {
+  const last = ops[ops.length - 1];
+  if ("insert" in op) {
+    if (op.insert === "") return;
+    if (last && "insert" in last) {
+      ops[ops.length - 1] = { insert: last.insert + op.insert };
+      return;
+    }
+    if (last && "delete" in last) {
+      // Keep inserts before deletes at the same position, like the server
+      ops.pop();
+      push(ops, op);
+      ops.push(last);
+      return;
+    }
+  } else if ("retain" in op) {
+    if (op.retain === 0) return;
+    if (last && "retain" in last) {
+      ops[ops.length - 1] = { retain: last.retain + op.retain };
+      return;
+    }
+  } else {
+    if (op.delete === 0) return;
+    if (last && "delete" in last) {
+      ops[ops.length - 1] = { delete: last.delete + op.delete };
+      return;
+    }
+  }
+  ops.push(op);
+}
+
+function chop(ops: Op[]): Op[] {
+  const last = ops[ops.length - 1];
+  if (last && "retain" in last) {
+    ops.pop();
+  }
+  return ops;
+}
+
+export function apply(text: string, ops: Op[]): string {
+  const parts: string[] = [];
+  let index = 0;
+  for (const op of ops) {
+    if ("retain" in op) {
+      const end = advance(text, index, op.retain);
+      parts.push(text.slice(index, end));
+      index = end;
+    } else if ("delete" in op) {
+      index = advance(text, index, op.delete);
+    } else {
+      parts.push(op.insert);
+    }
+  }
+  parts.push(text.slice(index));
+  return parts.join("");
+}
+
+// Single-region diff: common prefix and suffix are kept, the middle replaced
+export function diff(oldText: string, newText: string): Op[] {
+  const limit = Math.min(oldText.length, newText.length);
+  let prefix = 0;
+  while (prefix < limit && oldText.charCodeAt(prefix) === newText.charCodeAt(prefix)) {
+    prefix++;
+  }
+  // Never split a surrogate pair
+  if (prefix > 0 && isHighSurrogate(oldText.charCodeAt(prefix - 1))) {
+    prefix--;
+  }
+  let suffix = 0;
+  while (
+    suffix < limit - prefix &&
+    oldText.charCodeAt(oldText.length - 1 - suffix) === newText.charCodeAt(newText.length - 1 - suffix)
+  ) {
+    suffix++;
+  }
+  if (suffix > 0 && isHighSurrogate(oldText.charCodeAt(oldText.length - suffix - 1))) {
+    suffix--;
+  }
+  const ops: Op[] = [];
+  push(ops, { retain: codePointLength(oldText.slice(0, prefix)) });
+  push(ops, { delete: codePointLength(oldText.slice(prefix, oldText.length - suffix)) });
+  push(ops, { insert: newText.slice(prefix, newText.length - suffix) });
+  return chop(ops);
+}
+
+class Cursor {
+  private index = 0;
+  private offset = 0;
+
+  constructor(private ops: Op[]) {}
+
+  hasNext(): boolean {
+    return this.index < this.ops.length;
+  }
+
+  peekKind(): "retain" | "insert" | "delete" {
+    if (!this.hasNext()) return "retain";
+    const op = this.ops[this.index];
+    return "insert" in op ? "insert" : "delete" in op ? "delete" : "retain";
+  }
+
+  peekLength(): number {
+    if (!this.hasNext()) return Infinity;
+    const op = this.ops[this.index];
+    const length = "insert" in op ? codePointLength(op.insert) : "delete" in op ? op.delete : op.retain;
+    return length - this.offset;
+  }
+
+  take(length = Infinity): Op {
+    if (!this.hasNext()) return { retain: length };
+    const op = this.ops[this.index];
+    const remaining = this.peekLength();
+    const start = this.offset;
+    if (length >= remaining) {
+      length = remaining;
+      this.index++;
+      this.offset = 0;
+    } else {
+      this.offset += length;
+    }
+    if ("insert" in op) {
+      const begin = advance(op.insert, 0, start);
+      return { insert: op.insert.slice(begin, advance(op.insert, begin, length)) };
+    }
+    return "delete" in op ? { delete: length } : { retain: length };
+  }
+}
+
+// Rewrite `ops` to apply after `against`; `againstFirst` wins insert ties
+export function transform(ops: Op[], against: Op[], againstFirst = true): Op[] {
+  const result: Op[] = [];
+  const mine = new Cursor(ops);
+  const theirs = new Cursor(against);
+  while (mine.hasNext() || theirs.hasNext()) {
+    if (theirs.peekKind() === "insert" && (againstFirst || mine.peekKind() !== "insert")) {
+      push(result, { retain: theirs.peekLength() });
+      theirs.take();
+    } else if (mine.peekKind() === "insert") {
+      push(result, mine.take());
+    } else {
+      const length = Math.min(mine.peekLength(), theirs.peekLength());
+      const myOp = mine.take(length);
+      const theirOp = theirs.take(length);
+      if ("delete" in theirOp) continue;
+      push(result, "delete" in myOp ? { delete: length } : { retain: length });
+    }
+  }
+  return chop(result);
+}
@@ -11,32 +11,71 @@ interface Document {
   owned_by_current_user: boolean;
 }
 
+interface SearchResult extends Document {
+  // Escaped text with the hits wrapped in <mark>
+  snippet: string;
+}
+
 export default function Dashboard() {
   const [documents, setDocuments] = useState<Document[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [query, setQuery] = useState('');
+  const [results, setResults] = useState<SearchResult[]>([]);
   const { logout } = useAuth();
 
+  // The list comes a page at a time, newest first
+  const fetchDocuments = async (cursor: string | null) => {
+    try {
+      const url = cursor
+        ? `http://localhost:8000/documents?cursor=${encodeURIComponent(cursor)}`
+        : 'http://localhost:8000/documents';
+      const response = await fetch(url, {
+        headers: {
+          'Authorization': `Bearer ${localStorage.getItem('token')}`,
+        },
+      });
+      if (response.ok) {
+        const data: Document[] = await response.json();
+        setDocuments(prev => (cursor ? [...prev, ...data] : data));
+        setNextCursor(response.headers.get('X-Next-Cursor'));
+      }
+      if (response.status === 401) {
+        logout();
+      }
+    } catch (error) {
+      console.error('Error fetching documents:', error);
+    }
+  };
+
   useEffect(() => {
-    const fetchDocuments = async () => {
+    fetchDocuments(null);
+  }, []);
+
+  // Search as the user types, once they pause
+  useEffect(() => {
+    if (!query.trim()) {
+      setResults([]);
+      return;
+    }
+    const timer = setTimeout(async () => {
       try {
-        const response = await fetch('http://localhost:8000/documents', {
+        const response = await fetch(`http://localhost:8000/documents/search?q=${encodeURIComponent(query)}`, {
           headers: {
             'Authorization': `Bearer ${localStorage.getItem('token')}`,
           },
         });
         if (response.ok) {
-          const data = await response.json();
-          setDocuments(data);
+          setResults(await response.json());
         }
         if (response.status === 401) {
           logout();
         }
       } catch (error) {
-        console.error('Error fetching documents:', error);
+        console.error('Error searching documents:', error);
       }
-    };
-
-    fetchDocuments();
-  }, []);
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [query]);
 
   const createNewDocument = async () => {
     try {
@@ -93,7 +132,35 @@ export default function Dashboard() {
         </div>
       </div>
 
-      {documents.length === 0 ? (
+      <input
+        type="search"
+        value={query}
+        onChange={(e) => setQuery(e.target.value)}
+        placeholder="Search documents"
+        className="w-full mb-8 px-4 py-2 border rounded-lg"
+      />
+
+      {query.trim() ? (
+        results.length === 0 ? (
+          <p className="text-lg text-gray-600">No documents match your search.</p>
+        ) : (
+          <div className="flex flex-col gap-4">
+            {results.map((result) => (
+              <Link
+                key={result.id}
+                to={`/documents/${result.id}`}
+                className="p-4 border rounded-lg hover:shadow-lg transition-shadow"
+              >
+                <h2 className="font-semibold">{result.title}</h2>
+                <p
+                  className="text-sm text-gray-600 whitespace-pre-line"
+                  dangerouslySetInnerHTML={{ __html: result.snippet }}
+                />
+              </Link>
+            ))}
+          </div>
+        )
+      ) : documents.length === 0 ? (
         <div className="flex flex-col items-center justify-center h-64">
           <p className="mb-4 text-lg text-gray-600">You have no documents yet.</p>
           <button
@@ -125,6 +192,17 @@ export default function Dashboard() {
           ))}
         </div>
       )}
+
+      {!query.trim() && nextCursor && (
+        <div className="flex justify-center mt-8">
+          <button
+            onClick={() => fetchDocuments(nextCursor)}
+            className="px-4 py-2 bg-gray-600 text-white font-semibold rounded-lg shadow-md hover:bg-gray-700 transition duration-300 ease-in-out transform hover:scale-105"
+          >
+            Load more
+          </button>
+        </div>
+      )}
     </div>
   );
 } 
\ No newline at end of file
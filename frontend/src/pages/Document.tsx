@@ -8,21 +8,75 @@ import {
 } from "@/components/ui/dialog";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
+import { apply, diff, type Op, transform } from "@/lib/delta";
 import { useEffect, useRef, useState } from "react";
 import ReactQuill from "react-quill";
 import "react-quill/dist/quill.snow.css";
 import { useParams } from "react-router-dom";
 
+type Cursor = { index: number; length: number };
+type Member = { id: string; userId: number; email: string; cursor: Cursor | null };
+
+// The server merges presence per tick anyway; this just keeps us under its rate limit
+const PRESENCE_INTERVAL_MS = 100;
+
 export default function DocumentPage() {
   const { id } = useParams();
   const [content, setContent] = useState("");
   const [title, setTitle] = useState("");
   const [shareEmail, setShareEmail] = useState("");
+  const [suggestions, setSuggestions] = useState<string[]>([]);
   const [isLoading, setIsLoading] = useState(true);
   const [isConnected, setIsConnected] = useState(false);
+  // Everyone else in the room
+  const [members, setMembers] = useState<Member[]>([]);
   const quillRef = useRef<ReactQuill | null>(null);
   const ws = useRef<WebSocket | null>(null);
-    
+  // Delta protocol state: the last server revision we know of, the server
+  // content plus our unacknowledged delta, that delta, and the editor content
+  const rev = useRef(0);
+  const shadow = useRef<string | null>(null);
+  const inflight = useRef<Op[] | null>(null);
+  const local = useRef("");
+  // What GET /documents/{id} returned, used when the snapshot says it is current
+  const fetched = useRef<{ content: string; title: string } | null>(null);
+  // Presence: our connection's id, the room by connection, and our latest
+  // selection waiting to go out
+  const self = useRef<string | null>(null);
+  const room = useRef(new Map<string, Member>());
+  const cursor = useRef<Cursor | null>(null);
+  const presenceTimer = useRef<ReturnType<typeof setTimeout> | null>(null);
+
+  // Send whatever the editor has that the server doesn't, one delta at a time
+  const sendPending = () => {
+    if (shadow.current === null || inflight.current || ws.current?.readyState !== WebSocket.OPEN) {
+      return;
+    }
+    const ops = diff(shadow.current, local.current);
+    if (ops.length === 0) {
+      return;
+    }
+    ws.current.send(JSON.stringify({ type: "delta", rev: rev.current, ops }));
+    inflight.current = ops;
+    shadow.current = local.current;
+  };
+
+  // Apply a delta the server sequenced before ours, rebasing local edits over it
+  const applyRemote = (ops: Op[]) => {
+    if (shadow.current === null) {
+      return;
+    }
+    let remote = ops;
+    if (inflight.current) {
+      const rebased = transform(inflight.current, remote, true);
+      remote = transform(remote, inflight.current, false);
+      inflight.current = rebased;
+    }
+    const unsent = diff(shadow.current, local.current);
+    shadow.current = apply(shadow.current, remote);
+    local.current = apply(local.current, transform(remote, unsent, false));
+  };
+
   useEffect(() => {
     const token = localStorage.getItem('token');
     if (!token) {
@@ -30,8 +84,12 @@ export default function DocumentPage() {
       return;
     }
 
-    // Fetch initial document content
-    const fetchDocument = async () => {
+    let cancelled = false;
+
+    // Fetch the document. The browser revalidates its cached copy with the
+    // ETag, so reopening an unchanged document transfers almost nothing.
+    // Returns the ETag so the websocket can skip sending the same content.
+    const fetchDocument = async (): Promise<string | null> => {
       setIsLoading(true);
       try {
         const response = await fetch(`http://localhost:8000/documents/${id}`, {
@@ -44,50 +102,151 @@ export default function DocumentPage() {
           window.location.href = '/documents';
         }
         const data = await response.json();
-        setContent(data.content);
-        setTitle(data.title);
+        fetched.current = { content: data.content ?? "", title: data.title };
+        // The websocket snapshot is authoritative once it has arrived
+        if (shadow.current === null) {
+          setContent(data.content);
+          setTitle(data.title);
+        }
+        const etag = response.headers.get('ETag');
+        return etag ? etag.replace(/^W\//, "").replace(/"/g, "") : null;
       } catch (error) {
         console.error('Error fetching document:', error);
+        return null;
       } finally {
         setIsLoading(false);
       }
     };
 
-    // Only fetch if we're not creating a new document
-    if (id !== 'new') {
-      fetchDocument();
-    } else {
-      setIsLoading(false);
-    }
-
-    // WebSocket connection setup
-    ws.current = new WebSocket(`ws://localhost:8000/ws/${id}?token=${token}`);
+    const connect = (etag: string | null) => {
+      // WebSocket connection setup
+      const known = etag ? `&etag=${encodeURIComponent(etag)}` : "";
+      ws.current = new WebSocket(`ws://localhost:8000/ws/${id}?token=${token}${known}`);
 
-    ws.current.onmessage = (event) => {
-      const message = JSON.parse(event.data);
-      if (message.type === "update" && message.documentId === id) {
-        setContent(message.content);
-        if (message.title) {
-          setTitle(message.title);
+      ws.current.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.documentId !== undefined && message.documentId !== id) {
+          return;
         }
-      }
-    };
+        switch (message.type) {
+          case "snapshot": {
+            // Without content the copy we fetched is current
+            const snapshot = message.content === undefined ? fetched.current : message;
+            if (!snapshot) {
+              ws.current?.send(JSON.stringify({ type: "sync", rev: -1 }));
+              break;
+            }
+            rev.current = message.rev;
+            shadow.current = snapshot.content;
+            local.current = snapshot.content;
+            inflight.current = null;
+            setContent(snapshot.content);
+            setTitle(snapshot.title);
+            break;
+          }
+          case "ack":
+            if (message.rev <= rev.current) {
+              // Already acknowledged by a catchup
+              break;
+            }
+            if (message.rev !== rev.current + 1) {
+              ws.current?.send(JSON.stringify({ type: "sync", rev: rev.current }));
+              break;
+            }
+            rev.current = message.rev;
+            inflight.current = null;
+            sendPending();
+            break;
+          case "resync":
+            // The server dropped updates it had queued for us
+            ws.current?.send(JSON.stringify({ type: "sync", rev: rev.current }));
+            break;
+          case "delta":
+          case "catchup": {
+            const deltas = message.type === "delta" ? [message] : message.deltas;
+            for (const remote of deltas) {
+              if (remote.rev <= rev.current) {
+                continue;
+              }
+              if (remote.rev !== rev.current + 1) {
+                // Missed something; ask for what we don't have
+                ws.current?.send(JSON.stringify({ type: "sync", rev: rev.current }));
+                return;
+              }
+              if (remote.ack) {
+                // Our own delta, acknowledged as part of the catchup
+                inflight.current = null;
+              } else {
+                applyRemote(remote.ops);
+              }
+              rev.current = remote.rev;
+            }
+            if (message.title !== undefined) {
+              setTitle(message.title);
+            }
+            setContent(local.current);
+            sendPending();
+            break;
+          }
+          case "title":
+            setTitle(message.title);
+            break;
+          case "presence": {
+            if (message.self !== undefined) {
+              // Sent on join with the whole room
+              self.current = message.self;
+              room.current.clear();
+            }
+            for (const member of message.members as Member[]) {
+              room.current.set(member.id, member);
+            }
+            for (const left of message.left as string[]) {
+              room.current.delete(left);
+            }
+            setMembers([...room.current.values()].filter((member) => member.id !== self.current));
+            break;
+          }
+          case "error":
+            console.error("Server rejected update:", message.detail);
+            break;
+        }
+      };
 
-    ws.current.onopen = () => {
-      console.log("WebSocket connection established");
-      setIsConnected(true);
-    };
+      ws.current.onopen = () => {
+        console.log("WebSocket connection established");
+        setIsConnected(true);
+      };
 
-    ws.current.onerror = (error) => {
-      console.error("WebSocket error:", error);
-    };
+      ws.current.onerror = (error) => {
+        console.error("WebSocket error:", error);
+      };
 
-    ws.current.onclose = () => {
-      console.log("WebSocket connection closed");
-      setIsConnected(false);
+      ws.current.onclose = () => {
+        console.log("WebSocket connection closed");
+        setIsConnected(false);
+        room.current.clear();
+        setMembers([]);
+      };
     };
 
+    // Only fetch if we're not creating a new document
+    if (id !== 'new') {
+      fetchDocument().then((etag) => {
+        if (!cancelled) {
+          connect(etag);
+        }
+      });
+    } else {
+      setIsLoading(false);
+      connect(null);
+    }
+
     return () => {
+      cancelled = true;
+      if (presenceTimer.current) {
+        clearTimeout(presenceTimer.current);
+        presenceTimer.current = null;
+      }
       if (ws.current?.readyState === WebSocket.OPEN) {
         ws.current?.close();
       }
@@ -121,28 +280,79 @@ export default function DocumentPage() {
 
   const handleContentChange = (newContent: string) => {
     // Prevent unnecessary updates if content hasn't actually changed
-    if (newContent !== content) {
+    if (newContent !== local.current) {
+      local.current = newContent;
       setContent(newContent);
-      console.log("Sending updated content to the server");
-      // Send the updated content to the server
-      ws.current?.send(JSON.stringify({ 
-        type: "update", 
-        documentId: id, 
-        content: newContent 
-      }));
+      // Only the edit itself goes over the wire
+      sendPending();
+    }
+  };
+
+  // Selections come in on every keystroke and mouse move; send the latest
+  // one at most every PRESENCE_INTERVAL_MS
+  const handleSelectionChange = (range: Cursor | null) => {
+    cursor.current = range ? { index: range.index, length: range.length } : null;
+    if (presenceTimer.current) {
+      return;
+    }
+    presenceTimer.current = setTimeout(() => {
+      presenceTimer.current = null;
+      if (ws.current?.readyState === WebSocket.OPEN) {
+        ws.current.send(JSON.stringify({ type: "presence", cursor: cursor.current }));
+      }
+    }, PRESENCE_INTERVAL_MS);
+  };
+
+  // Where a member's cursor is, as a line number in our copy of the content
+  const describeCursor = (member: Member) => {
+    const editor = quillRef.current?.getEditor();
+    if (!member.cursor || !editor) {
+      return member.email;
     }
+    const line = editor.getLines(0, member.cursor.index).length || 1;
+    return `${member.email} (line ${line})`;
   };
 
   const handleTitleChange = (newTitle: string) => {
     setTitle(newTitle);
     ws.current?.send(JSON.stringify({
-      type: "update",
+      type: "title",
       documentId: id,
-      content,
       title: newTitle
     }));
   };
 
+  // Suggest addresses as the user types, once they pause
+  useEffect(() => {
+    const prefix = shareEmail.trim();
+    if (!prefix) {
+      setSuggestions([]);
+      return;
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const response = await fetch(`http://localhost:8000/users/search?q=${encodeURIComponent(prefix)}`, {
+          headers: { 'Authorization': `Bearer ${token}` },
+          signal: controller.signal
+        });
+        if (response.ok) {
+          const users: { id: number; email: string }[] = await response.json();
+          setSuggestions(users.map((user) => user.email));
+        }
+      } catch (error) {
+        if ((error as Error).name !== 'AbortError') {
+          console.error('Error looking up users:', error);
+        }
+      }
+    }, 150);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [shareEmail]);
+
   const handleShare = async () => {
     console.log("Sharing document with email:", shareEmail);
     try {
@@ -200,6 +410,17 @@ export default function DocumentPage() {
               <span className={`text-sm ${isConnected ? 'text-green-500' : 'text-red-500'}`}>
                 {isConnected ? 'Connected' : 'Disconnected'}
               </span>
+              <div className="flex -space-x-1">
+                {members.map((member) => (
+                  <span
+                    key={member.id}
+                    title={describeCursor(member)}
+                    className={`flex h-7 w-7 items-center justify-center rounded-full bg-blue-500 text-xs font-semibold uppercase text-white ring-2 ${member.cursor ? 'ring-green-400' : 'ring-white'}`}
+                  >
+                    {member.email.charAt(0)}
+                  </span>
+                ))}
+              </div>
               <Dialog>
                 <DialogTrigger asChild>
                   <Button variant="outline" className="ml-4">Share</Button>
@@ -219,7 +440,14 @@ export default function DocumentPage() {
                         onChange={(e) => setShareEmail(e.target.value)}
                         placeholder="user@example.com"
                         className="col-span-3 border border-gray-300 rounded-md"
+                        list="share-suggestions"
+                        autoComplete="off"
                       />
+                      <datalist id="share-suggestions">
+                        {suggestions.map((email) => (
+                          <option key={email} value={email} />
+                        ))}
+                      </datalist>
                     </div>
                   </div>
                   <Button onClick={handleShare} className="mt-4 bg-blue-500 text-white hover:bg-blue-600">
@@ -234,6 +462,7 @@ export default function DocumentPage() {
             theme="snow"
             value={content}
             onChange={handleContentChange}
+            onChangeSelection={handleSelectionChange}
             modules={modules}
             formats={formats}
             preserveWhitespace={true}